@@ -0,0 +1,175 @@
+"""on_llm_request / on_llm_response 热路径的离线基准测试
+
+用本地替身代替AstrBot的知识库、嵌入与LLM,模拟N个并发会话各发送M条消息,
+输出每个钩子额外增加的延迟分位数、吞吐、压缩器内存增长与压缩/上传次数(JSON)。
+
+    python bench/bench_hotpath.py --sessions 200 --messages 120 --llm-latency 0.5 --output bench.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, BENCH_DIR)
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+
+from fakes import FakeContext, FakeEvent, Latency, LLMResponse, ProviderRequest, install_astrbot_stubs  # noqa: E402
+
+WORDS = ["今天", "天气", "不错", "我们", "去", "吃饭", "明天", "开会", "项目", "进度", "ok", "哈哈", "周末", "电影", "游戏", "代码", "上线"]
+
+
+def percentile(samples: list[float], q: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, max(0, round(q / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(samples: list[float]) -> dict:
+    return {
+        "count": len(samples),
+        "mean_ms": sum(samples) / len(samples) * 1000 if samples else 0.0,
+        "p50_ms": percentile(samples, 50) * 1000,
+        "p95_ms": percentile(samples, 95) * 1000,
+        "p99_ms": percentile(samples, 99) * 1000,
+        "max_ms": max(samples) * 1000 if samples else 0.0,
+    }
+
+
+def read_version() -> str:
+    with open(os.path.join(os.path.dirname(BENCH_DIR), "metadata.yaml"), encoding="utf-8") as f:
+        for line in f:
+            if line.startswith("version:"):
+                return line.split("#")[0].split(":", 1)[1].strip()
+    return ""
+
+
+def parse_value(value: str):
+    for cast in (int, float):
+        try:
+            return cast(value)
+        except ValueError:
+            pass
+    return value
+
+
+async def run_session(plugin, index: int, args, rng: random.Random, request_times: list, response_times: list):
+    group_id = str(100000 + index) if index % 5 else None
+    sender_id = str(200000 + index)
+    for message_index in range(args.messages):
+        text = " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, args.max_words)))
+        event = FakeEvent(group_id, sender_id, f"user{index}", text)
+        start = time.perf_counter()
+        await plugin.on_llm_request(event, ProviderRequest(prompt=text))
+        request_times.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        await plugin.on_llm_response(event, LLMResponse(f"回复{message_index}: {text}"))
+        response_times.append(time.perf_counter() - start)
+        if args.think_time:
+            await asyncio.sleep(rng.uniform(0, args.think_time))
+
+
+async def run(args) -> dict:
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="memorychain_bench_")
+    install_astrbot_stubs(data_dir)
+    import main
+
+    latency = Latency(
+        llm=args.llm_latency,
+        embed=args.embed_latency,
+        search=args.search_latency,
+        kb_lookup=args.kb_lookup_latency,
+        db_write=args.db_write_latency,
+    )
+    context = FakeContext(latency)
+    config = {
+        "enabled": 1,
+        "max_history": args.max_history,
+        "compress_threshold": args.compress_threshold,
+    }
+    for item in args.set:
+        key, _, value = item.partition("=")
+        config[key] = parse_value(value)
+    plugin = main.memorychain(context, config)
+    plugin.llm_name = "fake-llm"
+    plugin.ep_name = "fake-embedding"
+    await plugin.initialize()
+
+    memory_before = plugin.compressor.memory_usage()
+    request_times: list[float] = []
+    response_times: list[float] = []
+    rng = random.Random(args.seed)
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        run_session(plugin, index, args, random.Random(rng.random()), request_times, response_times)
+        for index in range(args.sessions)
+    ))
+    elapsed = time.perf_counter() - start
+    memory_after = plugin.compressor.memory_usage()
+    session_count = len(plugin.compressor.compressed_chats)
+
+    drain_start = time.perf_counter()
+    await plugin.terminate()
+    drain = time.perf_counter() - drain_start
+
+    total_messages = args.sessions * args.messages
+    return {
+        "version": read_version(),
+        "params": {key: value for key, value in vars(args).items() if key != "output"},
+        "throughput_msgs_per_s": total_messages / elapsed if elapsed else 0.0,
+        "elapsed_s": elapsed,
+        "drain_s": drain,
+        "on_llm_request": summarize(request_times),
+        "on_llm_response": summarize(response_times),
+        "compressor": {
+            "sessions": session_count,
+            "memory_before_bytes": memory_before,
+            "memory_after_bytes": memory_after,
+            "memory_growth_bytes": memory_after - memory_before,
+            "bytes_per_session": memory_after // session_count if session_count else 0,
+            "compressions": plugin.compressor.compressions,
+            "prompt_tokens": plugin.compressor.prompt_tokens,
+        },
+        "calls": vars(context.counters),
+        "plugin_counters": dict(plugin.metrics.counters),
+        "kbs": len(context.kb_manager.kb_insts),
+        "documents": sum(len(helper.documents) for helper in context.kb_manager.kb_insts.values()),
+    }
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sessions", type=int, default=100, help="并发会话数")
+    parser.add_argument("--messages", type=int, default=120, help="每个会话的消息数")
+    parser.add_argument("--max-words", type=int, default=12, help="每条消息的最大词数")
+    parser.add_argument("--think-time", type=float, default=0.0, help="两条消息之间的最大随机间隔(秒)")
+    parser.add_argument("--llm-latency", type=float, default=0.5)
+    parser.add_argument("--embed-latency", type=float, default=0.05)
+    parser.add_argument("--search-latency", type=float, default=0.01)
+    parser.add_argument("--kb-lookup-latency", type=float, default=0.0)
+    parser.add_argument("--db-write-latency", type=float, default=0.005)
+    parser.add_argument("--max-history", type=int, default=60)
+    parser.add_argument("--compress-threshold", type=int, default=50)
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE", help="覆盖插件配置项,可重复")
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--data-dir", default="", help="插件数据目录,默认使用临时目录")
+    parser.add_argument("--output", default="", help="结果JSON写入的文件,默认输出到标准输出")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    content = json.dumps(result, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            f.write(content)
+    else:
+        print(content)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,362 @@
+"""离线基准测试使用的AstrBot替身
+
+install_astrbot_stubs() 在 sys.modules 中注册最小化的 astrbot 模块,使 main.py 可以脱离框架导入;
+FakeContext 提供 kb_manager、provider_manager 与 llm_generate 的本地实现,每一步都可以配置人为延迟。
+"""
+from dataclasses import dataclass, field
+import asyncio
+import logging
+import sys
+import time
+import types
+import uuid
+
+
+@dataclass
+class Latency:
+    """各个外部调用的人为延迟(秒)"""
+    llm: float = 0.5                # llm_generate 一次调用
+    embed: float = 0.05             # 一次嵌入请求(每批)
+    search: float = 0.01            # 一次向量检索
+    kb_lookup: float = 0.0          # get_kb_by_name 每个数据库的扫描开销
+    db_write: float = 0.005         # 上传文档后写元数据
+
+
+@dataclass
+class Counters:
+    llm_calls: int = 0
+    embed_calls: int = 0
+    embedded_chunks: int = 0
+    retrieve_calls: int = 0
+    kb_lookups: int = 0
+    uploads: int = 0
+
+
+class Provider:
+    pass
+
+
+class EmbeddingProvider:
+    def __init__(self, latency: Latency, counters: Counters):
+        self.latency = latency
+        self.counters = counters
+
+    async def get_embedding(self, text: str) -> list[float]:
+        return (await self.get_embeddings([text]))[0]
+
+    async def get_embeddings(self, texts: list[str]) -> list[list[float]]:
+        self.counters.embed_calls += 1
+        self.counters.embedded_chunks += len(texts)
+        await asyncio.sleep(self.latency.embed)
+        return [[float(len(text))] for text in texts]
+
+
+class FakeLLMProvider(Provider):
+    pass
+
+
+@dataclass
+class KnowledgeBase:
+    kb_name: str
+    embedding_provider_id: str | None = None
+    kb_id: str = field(default_factory=lambda: str(uuid.uuid4()))
+    id: int = 0
+
+
+@dataclass
+class KBDocument:
+    doc_id: str
+    kb_id: str
+    doc_name: str
+    chunk_count: int
+    created_at: float = field(default_factory=time.time)
+    file_type: str = "txt"
+
+
+class KBHelper:
+    """内存中的知识库,嵌入走 EmbeddingProvider 替身以计入延迟"""
+    def __init__(self, kb: KnowledgeBase, ep: EmbeddingProvider, latency: Latency, counters: Counters):
+        self.kb = kb
+        self.ep = ep
+        self.latency = latency
+        self.counters = counters
+        self.documents: dict[str, KBDocument] = {}
+        self.chunks: dict[str, list[str]] = {}
+
+    async def get_ep(self) -> EmbeddingProvider:
+        return self.ep
+
+    async def upload_document(self, file_name, file_content, file_type, chunk_size=512, chunk_overlap=50,
+                              batch_size=32, tasks_limit=3, max_retries=3, progress_callback=None,
+                              pre_chunked_text=None) -> KBDocument:
+        texts = list(pre_chunked_text or [])
+        batches = [texts[i:i + batch_size] for i in range(0, len(texts), batch_size)]
+        semaphore = asyncio.Semaphore(tasks_limit)
+
+        async def embed(batch):
+            async with semaphore:
+                await self.ep.get_embeddings(batch)
+
+        await asyncio.gather(*(embed(batch) for batch in batches))
+        await asyncio.sleep(self.latency.db_write)
+        doc = KBDocument(str(uuid.uuid4()), self.kb.kb_id, file_name, len(texts), file_type=file_type)
+        self.documents[doc.doc_id] = doc
+        self.chunks[doc.doc_id] = texts
+        self.counters.uploads += 1
+        return doc
+
+    async def list_documents(self, offset: int = 0, limit: int = 100) -> list[KBDocument]:
+        docs = sorted(self.documents.values(), key=lambda doc: doc.created_at)
+        return docs[offset:offset + limit]
+
+    async def get_document(self, doc_id: str) -> KBDocument | None:
+        return self.documents.get(doc_id)
+
+    async def delete_document(self, doc_id: str):
+        self.documents.pop(doc_id, None)
+        self.chunks.pop(doc_id, None)
+
+    async def get_chunks_by_doc_id(self, doc_id: str, offset: int = 0, limit: int = 100) -> list[dict]:
+        texts = self.chunks.get(doc_id, [])[offset:offset + limit]
+        return [
+            {"chunk_id": f"{doc_id}-{offset + i}", "doc_id": doc_id, "kb_id": self.kb.kb_id,
+             "chunk_index": offset + i, "content": text, "char_count": len(text)}
+            for i, text in enumerate(texts)
+        ]
+
+    async def delete_vec_db(self):
+        self.documents.clear()
+        self.chunks.clear()
+
+
+class _FakeSession:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        pass
+
+    async def delete(self, obj):
+        pass
+
+    async def commit(self):
+        pass
+
+
+class FakeKBDB:
+    def __init__(self, manager: "FakeKBManager"):
+        self.manager = manager
+
+    def get_db(self) -> _FakeSession:
+        return _FakeSession()
+
+    async def list_kbs(self, offset: int = 0, limit: int = 100) -> list[KnowledgeBase]:
+        kbs = [helper.kb for helper in self.manager.kb_insts.values()]
+        return kbs[offset:offset + limit]
+
+    async def get_kb_by_name(self, kb_name: str) -> KnowledgeBase | None:
+        helper = await self.manager.get_kb_by_name(kb_name)
+        return helper.kb if helper else None
+
+
+class FakeKBManager:
+    def __init__(self, context: "FakeContext"):
+        self.context = context
+        self.kb_insts: dict[str, KBHelper] = {}
+        self.kb_db = FakeKBDB(self)
+
+    async def get_kb(self, kb_id: str) -> KBHelper | None:
+        return self.kb_insts.get(kb_id)
+
+    async def get_kb_by_name(self, kb_name: str) -> KBHelper | None:
+        self.context.counters.kb_lookups += 1
+        for kb_helper in self.kb_insts.values():
+            if self.context.latency.kb_lookup:
+                await asyncio.sleep(self.context.latency.kb_lookup)
+            if kb_helper.kb.kb_name == kb_name:
+                return kb_helper
+        return None
+
+    async def create_kb(self, kb_name: str, embedding_provider_id: str | None = None, **kwargs) -> KBHelper:
+        if embedding_provider_id is None:
+            raise ValueError("创建知识库时必须提供embedding_provider_id")
+        ep = self.context.provider_manager.inst_map[embedding_provider_id]
+        kb = KnowledgeBase(kb_name, embedding_provider_id, id=len(self.kb_insts) + 1)
+        helper = KBHelper(kb, ep, self.context.latency, self.context.counters)
+        self.kb_insts[kb.kb_id] = helper
+        return helper
+
+    async def update_kb(self, kb_id: str, kb_name: str, **kwargs) -> KBHelper | None:
+        helper = self.kb_insts.get(kb_id)
+        if helper is not None:
+            helper.kb.kb_name = kb_name
+        return helper
+
+    async def load_kbs(self):
+        pass
+
+    async def retrieve(self, query: str, kb_names: list[str], top_k_fusion: int = 20, top_m_final: int = 5) -> dict | None:
+        self.context.counters.retrieve_calls += 1
+        helpers = [helper for helper in self.kb_insts.values() if helper.kb.kb_name in kb_names]
+        if not helpers:
+            return {}
+        await self.context.provider_manager.inst_map["fake-embedding"].get_embedding(query)
+        await asyncio.sleep(self.context.latency.search)
+        query_chars = set(query)
+        results = []
+        for helper in helpers:
+            for doc_id, texts in helper.chunks.items():
+                for index, text in enumerate(texts):
+                    score = len(query_chars & set(text)) / (len(query_chars) or 1)
+                    results.append({
+                        "chunk_id": f"{doc_id}-{index}", "doc_id": doc_id, "kb_id": helper.kb.kb_id,
+                        "kb_name": helper.kb.kb_name, "doc_name": helper.documents[doc_id].doc_name,
+                        "chunk_index": index, "content": text, "score": score, "char_count": len(text),
+                    })
+        results.sort(key=lambda r: r["score"], reverse=True)
+        results = results[:top_m_final]
+        if not results:
+            return None
+        return {"context_text": "", "results": results}
+
+
+class FakeProviderManager:
+    def __init__(self, latency: Latency, counters: Counters):
+        self.inst_map = {
+            "fake-llm": FakeLLMProvider(),
+            "fake-embedding": EmbeddingProvider(latency, counters),
+        }
+
+    async def get_provider_by_id(self, provider_id: str):
+        return self.inst_map.get(provider_id)
+
+
+class LLMResponse:
+    def __init__(self, completion_text: str = "", role: str = "assistant"):
+        self.completion_text = completion_text
+        self.role = role
+
+
+class ProviderRequest:
+    def __init__(self, prompt: str = "", system_prompt: str = ""):
+        self.prompt = prompt
+        self.system_prompt = system_prompt
+
+
+class FakeContext:
+    """Context替身: kb_manager、provider_manager与llm_generate"""
+    def __init__(self, latency: Latency):
+        self.latency = latency
+        self.counters = Counters()
+        self.provider_manager = FakeProviderManager(latency, self.counters)
+        self.kb_manager = FakeKBManager(self)
+
+    def get_provider_by_id(self, provider_id: str):
+        return self.provider_manager.inst_map.get(provider_id)
+
+    async def llm_generate(self, chat_provider_id: str, prompt: str, **kwargs) -> LLMResponse:
+        self.counters.llm_calls += 1
+        await asyncio.sleep(self.latency.llm)
+        lines = [line for line in prompt.splitlines() if ": " in line]
+        return LLMResponse(f"摘要({len(lines)}条): " + " ".join(line[:20] for line in lines[-5:]))
+
+
+class FakeEvent:
+    def __init__(self, group_id: str | None, sender_id: str, sender_name: str, message_str: str):
+        self.group_id = group_id
+        self.sender_id = sender_id
+        self.sender_name = sender_name
+        self.message_str = message_str
+
+    def get_group_id(self):
+        return self.group_id
+
+    def get_sender_id(self):
+        return self.sender_id
+
+    def get_sender_name(self):
+        return self.sender_name
+
+    def plain_result(self, text: str):
+        return text
+
+
+class Star:
+    def __init__(self, context):
+        self.context = context
+
+
+class _CommandGroup:
+    def __init__(self, func):
+        self.func = func
+
+    def command(self, name: str):
+        return lambda func: func
+
+
+class _Filter:
+    @staticmethod
+    def command_group(name: str):
+        return _CommandGroup
+
+    @staticmethod
+    def on_llm_request(**kwargs):
+        return lambda func: func
+
+    @staticmethod
+    def on_llm_response(**kwargs):
+        return lambda func: func
+
+
+class StarTools:
+    data_dir = "."
+
+    @classmethod
+    def get_data_dir(cls):
+        return cls.data_dir
+
+
+def _module(name: str, **attrs) -> types.ModuleType:
+    module = types.ModuleType(name)
+    module.__dict__.update(attrs)
+    sys.modules[name] = module
+    return module
+
+
+def install_astrbot_stubs(data_dir: str):
+    """注册 main.py 用到的 astrbot 模块替身"""
+    StarTools.data_dir = data_dir
+    for name in ("astrbot", "astrbot.core", "astrbot.core.provider", "astrbot.core.knowledge_base"):
+        _module(name)
+    _module("astrbot.core.provider.provider", EmbeddingProvider=EmbeddingProvider, Provider=Provider)
+    _module("astrbot.core.knowledge_base.kb_helper", KBHelper=KBHelper, KBDocument=KBDocument)
+    _module("astrbot.core.knowledge_base.kb_db_sqlite", KBSQLiteDatabase=FakeKBDB)
+    _module("astrbot.core.knowledge_base.models", KnowledgeBase=KnowledgeBase)
+    _module("astrbot.api", AstrBotConfig=dict, logger=logging.getLogger("memorychain.bench"))
+    _module("astrbot.api.provider", ProviderRequest=ProviderRequest, LLMResponse=LLMResponse)
+    _module("astrbot.api.event", filter=_Filter(), AstrMessageEvent=FakeEvent)
+    _module("astrbot.api.star", Context=FakeContext, Star=Star, register=lambda *args: (lambda cls: cls), StarTools=StarTools)
+    try:
+        import aiofiles  # noqa: F401
+    except ImportError:
+        _install_aiofiles_stub()
+
+
+def _install_aiofiles_stub():
+    class _AsyncFile:
+        def __init__(self, *args, **kwargs):
+            self.file = open(*args, **kwargs)
+
+        async def __aenter__(self):
+            return self
+
+        async def __aexit__(self, *exc):
+            self.file.close()
+
+        async def read(self):
+            return self.file.read()
+
+        async def write(self, data):
+            return self.file.write(data)
+
+    _module("aiofiles", open=_AsyncFile)
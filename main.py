@@ -6,12 +6,21 @@ from astrbot.core.knowledge_base.models import KnowledgeBase
 from astrbot.api.event import filter, AstrMessageEvent
 from astrbot.api.star import Context, Star, register
 from astrbot.api import AstrBotConfig, logger
-from typing import Callable, Dict, Optional
+from typing import Awaitable, Callable, Dict, Optional
 from dataclasses import dataclass, field
 from astrbot.api.star import StarTools
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
 import aiofiles
+import asyncio
+import sqlite3
+import re
+import bisect
+import datetime
+import hashlib
 import json
 import time
+import sys
 import os
 
 @register("memorychain", "Lishining", "记忆链", "1.0.0")
@@ -31,16 +40,131 @@ class memorychain(Star):
         # 数据文件路径
         self.data_file = os.path.join(self.data_dir, "memorychain_data.json")
 
+        # 各阶段耗时与计数
+        self.metrics = PluginMetrics(max_sessions = int(self.Config.get("metrics_max_sessions", 1000)))
+        self.metrics_file = os.path.join(self.data_dir, "memorychain_metrics.prom")
+        self._metrics_task: asyncio.Task | None = None
+
         # 初始化内存中的数据
         self.compressed_sessions: set = set()
-        self.compressor = SimpleChatCompressor(max_history, compress_threshold)
+        self.compressor = SimpleChatCompressor(
+            max_history,
+            compress_threshold,
+            max_sessions = int(self.Config.get("max_sessions", 2000)),
+            idle_timeout = float(self.Config.get("session_idle_timeout", 3600)),
+            on_evict = self._on_session_evicted,
+            token_budget = int(self.Config.get("compress_token_budget", 0)),
+            estimator = TOKEN_ESTIMATORS.get(self.Config.get("token_estimator", "cjk"), estimate_tokens_cjk),
+            rolling = self.Config.get("compress_mode", "window") == "rolling"
+        )
+        self._sweep_task: asyncio.Task | None = None
+
+        # 未压缩消息的追加日志,重启后回放
+        self.journal: ChatJournal | None = None
+        if self.Config.get("journal_enabled", 1) == 1:
+            self.journal = ChatJournal(
+                os.path.join(self.data_dir, "memorychain_journal.db"),
+                flush_interval = float(self.Config.get("journal_flush_interval", 1)),
+                batch_size = int(self.Config.get("journal_batch_size", 200))
+            )
+
+        # 后台压缩任务池,总结与上传不再阻塞回复
+        self.compress_pool = CompressionWorkerPool(
+            handler = self._run_compression_job,
+            workers = int(self.Config.get("compress_workers", 2)),
+            queue_size = int(self.Config.get("compress_queue_size", 100)),
+            policy = self.Config.get("compress_queue_policy", "drop_oldest"),
+            on_fail = self._on_compression_failed
+        )
+
+        # 检索结果缓存,写入记忆时按数据库失效
+        self.retrieval_cache = RetrievalCache(
+            max_size = int(self.Config.get("retrieval_cache_size", 256)),
+            ttl = float(self.Config.get("retrieval_cache_ttl", 60)),
+            max_generations = int(self.Config.get("max_sessions", 2000))
+        )
+
+        # 记忆数据库句柄缓存,避免每条消息都按名称查找数据库
+        self.kb_handles = KBHandleCache(
+            context = self.context,
+            negative_ttl = float(self.Config.get("kb_negative_ttl", 30)),
+            max_size = int(self.Config.get("max_sessions", 2000))
+        )
+
+        # 最近记忆的SimHash指纹,上传前检测近似重复
+        self.fingerprints = MemoryFingerprintIndex(
+            os.path.join(self.data_dir, "memorychain_fingerprints.json"),
+            max_distance = int(self.Config.get("dedup_max_distance", 6)),
+            recent = int(self.Config.get("dedup_recent", 64)),
+            enabled = self.Config.get("dedup_action", "skip") in ("skip", "merge"),
+            delay = float(self.Config.get("save_delay", 2))
+        )
+
+        # 记忆数据库的后台整理: 按周/月合并旧文档,执行保留期限与文档数上限
+        self.compactor = MemoryCompactor(
+            summarize = self._compaction_summarize,
+            uploader = self.upload_memory,
+            period = self.Config.get("compaction_period", "week"),
+            min_age_days = float(self.Config.get("compaction_min_age_days", 7)),
+            min_docs = int(self.Config.get("compaction_min_docs", 3)),
+            retention_days = float(self.Config.get("retention_days", 0)),
+            max_docs = int(self.Config.get("max_docs_per_kb", 0)),
+            concurrency = int(self.Config.get("compaction_concurrency", 1)),
+            throttle = float(self.Config.get("compaction_throttle", 1)),
+            is_busy = lambda: self.compress_pool.queue is not None and self.compress_pool.queue.qsize() > 0,
+            on_removed = self._on_memory_removed,
+            lock_for = self._kb_lock,
+            is_migrating = lambda kb_name: kb_name in self._migrating
+        )
+        self._compaction_task: asyncio.Task | None = None
+        self._manual_compaction_task: asyncio.Task | None = None    # memorychain compact命令启动的整理
+        self._warmup_task: asyncio.Task | None = None
+
+        # 记忆数据库的导出、导入与重新嵌入,支持断点续传
+        self.migrator = MemoryMigrator(
+            uploader = self.upload_memory,
+            work_dir = os.path.join(self.data_dir, "migrations"),
+            concurrency = int(self.Config.get("migrate_concurrency", 2))
+        )
+        self.export_dir = os.path.join(self.data_dir, "exports")
+        self._migration_task: asyncio.Task | None = None
+        self._migrating: set[str] = set()                       # 正在重新嵌入的数据库,不参与整理
+        self._kb_locks = KeyedLocks(int(self.Config.get("max_sessions", 2000)))   # 写入记忆与切换数据库互斥
+
+        # 检索前的本地过滤
+        self.retrieval_gate = RetrievalGate(
+            min_length = int(self.Config.get("gate_min_length", 2)),
+            cooldown = float(self.Config.get("gate_cooldown", 0)),
+            reuse_threshold = float(self.Config.get("gate_reuse_threshold", 0.9)),
+            extra_stopwords = self.Config.get("gate_stopwords", ""),
+            max_sessions = int(self.Config.get("max_sessions", 2000))
+        )
+
+        # 注入上下文的筛选: 数量、分数、去重与token预算
+        self.context_selector = ContextSelector(
+            top_k = int(self.Config.get("retrieve_top_k", 5)),
+            min_score = float(self.Config.get("retrieve_min_score", 0)),
+            dedup_threshold = float(self.Config.get("inject_dedup_threshold", 0.8)),
+            token_budget = int(self.Config.get("inject_token_budget", 800)),
+            estimator = self.compressor.estimator
+        )
 
         # 需要持久化的数据
         self.bot_name: Dict[str, str] = {}
         self.llm_name: Optional[str] = None
         self.llm_fun: Optional[Callable] = None
+        self.llm_client: FailoverLLM | None = None
+        self.compaction_llm: FailoverLLM | None = None
         self.ep_name: Optional[str] = None
 
+        # 合并写入+原子替换的持久化
+        self.data_writer = DebouncedJsonWriter(
+            self.data_file,
+            snapshot = self._snapshot_data,
+            delay = float(self.Config.get("save_delay", 2)),
+            observer = lambda seconds: self.metrics.observe("save_data", seconds)
+        )
+
     async def _load_data(self):
         """异步加载持久化数据"""
         try:
@@ -52,43 +176,63 @@ class memorychain(Star):
                         self.bot_name = data.get("bot_name", {})
                         self.llm_name = data.get("llm_name", None)
                         self.ep_name = data.get("ep_name", None)
+                        self.data_writer.mark_clean(self._snapshot_data())
                         logger.info("[memorychain] 持久化数据加载成功")
         except (json.JSONDecodeError, OSError) as e:
             logger.error(f"[memorychain] 加载持久化数据失败: {e}")
         except Exception as e:
             logger.error(f"[memorychain] 加载数据时发生未知错误: {e}")
 
+    def _snapshot_data(self) -> dict:
+        """需要持久化的数据快照"""
+        return {
+            "bot_name": dict(self.bot_name),
+            "llm_name": self.llm_name,
+            "ep_name": self.ep_name
+        }
+
     async def _save_data(self):
-        """异步保存持久化数据"""
-        try:
-            # 准备要保存的数据
-            data = {
-                "bot_name": self.bot_name,
-                "llm_name": self.llm_name,
-                "ep_name": self.ep_name,
-                "last_updated": time.time()
-            }
-
-            # 确保数据目录存在
-            os.makedirs(os.path.dirname(self.data_file), exist_ok=True)
-
-            # 异步写入文件
-            async with aiofiles.open(self.data_file, 'w', encoding='utf-8') as f:
-                await f.write(json.dumps(data, indent=4, ensure_ascii=False))
-
-            logger.debug("[memorychain] 持久化数据保存成功")
-        except OSError as e:
-            logger.error(f"[memorychain] 保存持久化数据失败: {e}")
-        except Exception as e:
-            logger.error(f"[memorychain] 保存数据时发生未知错误: {e}")
+        """异步保存持久化数据,短时间内的多次保存会被合并为一次写入"""
+        self.data_writer.schedule()
 
     async def terminate(self):
         """插件终止时自动保存数据"""
-        await self._save_data()
+        if self._sweep_task is not None:
+            self._sweep_task.cancel()
+        if self._metrics_task is not None:
+            self._metrics_task.cancel()
+        if self._compaction_task is not None:
+            self._compaction_task.cancel()
+        if self._manual_compaction_task is not None:
+            self._manual_compaction_task.cancel()
+        if self._migration_task is not None:
+            self._migration_task.cancel()
+        if self._warmup_task is not None:
+            self._warmup_task.cancel()
+        await self.compress_pool.drain(float(self.Config.get("compress_drain_timeout", 30)))
+        if self.journal is not None:
+            await self.journal.close()
+        await self.data_writer.flush()
+        await self.fingerprints.writer.flush()
         logger.info("[memorychain] 插件终止，数据已保存")
 
     async def initialize(self):
+        start = time.perf_counter()
         await self._load_data()
+        await self.fingerprints.load()
+        if self.journal is not None:
+            await self._replay_journal()
+        try:
+            await self._recover_reembeds()
+        except Exception as e:
+            logger.error(f"[memorychain] 恢复中断的重新嵌入失败: {e}")
+        self.compress_pool.start()
+        if self.compressor.idle_timeout > 0:
+            self._sweep_task = asyncio.create_task(self._sweep_loop())
+        if float(self.Config.get("metrics_export_interval", 0)) > 0:
+            self._metrics_task = asyncio.create_task(self._export_metrics_loop())
+        if float(self.Config.get("compaction_interval", 0)) > 0:
+            self._compaction_task = asyncio.create_task(self._compaction_loop())
         if self.llm_name is None:
             logger.info("[memorychain] 没有配置llm_name,请尽快配置")
         else:
@@ -96,6 +240,85 @@ class memorychain(Star):
                 await self._set_llm(self.llm_name)
             except:
                 logger.info("[memorychain] 没有配置llm_name失败,请手动配置")
+        elapsed = time.perf_counter() - start
+        self.metrics.observe("initialize", elapsed)
+        logger.info(f"[memorychain] 初始化完成,耗时{elapsed * 1000:.1f}ms")
+        # 预热在后台进行,不阻塞接收消息
+        if self.Config.get("warmup_enabled", 1) == 1:
+            self._warmup_task = asyncio.create_task(self._warm_up(start))
+
+    async def _warm_up(self, started_at: float):
+        """预先打开所有记忆数据库并发出一次探测嵌入,避免重启后每个会话的第一条消息承担冷启动开销"""
+        try:
+            kb_manager = self.context.kb_manager
+            kbs = [kb for kb in await self.get_all_kbs(kb_manager.kb_db) if kb.kb_name.endswith("记忆链")]
+            # 日志中有未压缩消息的会话最先需要数据库,优先预热
+            active = {chat.kb_name for chat in self.compressor.compressed_chats.values()}
+            kbs.sort(key = lambda kb: kb.kb_name not in active)
+            semaphore = asyncio.Semaphore(max(1, int(self.Config.get("warmup_concurrency", 4))))
+
+            async def open_kb(kb: KnowledgeBase) -> KBHelper | None:
+                async with semaphore:
+                    try:
+                        kb_helper: KBHelper | None = await kb_manager.get_kb(kb.kb_id)
+                        if kb_helper is None:
+                            return None
+                        # 读取一次文档列表,触发向量库与文档库的打开
+                        await kb_helper.list_documents(offset = 0, limit = 1)
+                        self.kb_handles.set(kb.kb_name, kb_helper)
+                        return kb_helper
+                    except Exception as e:
+                        logger.warning(f"[memorychain] 预热数据库{kb.kb_name}失败: {e}")
+                        return None
+
+            kb_helpers = [kb_helper for kb_helper in await asyncio.gather(*(open_kb(kb) for kb in kbs)) if kb_helper]
+            # 每个编码器发出一次探测嵌入,建立连接
+            providers: dict[int, EmbeddingProvider] = {}
+            for kb_helper in kb_helpers:
+                try:
+                    ep = await kb_helper.get_ep()
+                except Exception as e:
+                    logger.warning(f"[memorychain] 获取数据库{kb_helper.kb.kb_name}的编码器失败: {e}")
+                    continue
+                if ep is not None:
+                    providers.setdefault(id(ep), ep)
+            if self.ep_name is not None and isinstance(self.context.get_provider_by_id(self.ep_name), EmbeddingProvider):
+                ep = self.context.get_provider_by_id(self.ep_name)
+                providers.setdefault(id(ep), ep)
+
+            async def probe(ep: EmbeddingProvider):
+                try:
+                    await ep.get_embedding("预热")
+                except Exception as e:
+                    logger.warning(f"[memorychain] 编码器探测失败: {e}")
+
+            await asyncio.gather(*(probe(ep) for ep in providers.values()))
+            elapsed = time.perf_counter() - started_at
+            self.metrics.observe("warmup", elapsed)
+            self.metrics.inc("warmup_kbs", value = len(kb_helpers))
+            logger.info(f"[memorychain] 预热完成: {len(kb_helpers)}/{len(kbs)}个记忆数据库,{len(providers)}个编码器,启动总耗时{elapsed * 1000:.1f}ms")
+        except Exception as e:
+            logger.error(f"[memorychain] 预热失败: {e}")
+
+    async def _replay_journal(self):
+        """从日志恢复上次退出时未压缩的会话缓冲区"""
+        start = time.perf_counter()
+        try:
+            sessions, summaries = await self.journal.open(self.compressor.max_sessions)
+        except Exception as e:
+            logger.error(f"[memorychain] 打开聊天日志失败,本次不记录日志: {e}")
+            self.journal = None
+            return
+        message_count = 0
+        for session_id, (kb_name, lines, last_seq) in sessions.items():
+            self.compressor.load_session(session_id, kb_name, lines, last_seq, summaries.pop(session_id, ("", ""))[1])
+            message_count += len(lines)
+        # 只有滚动摘要的会话不占用内存,再次活跃时连同摘要一起载入
+        self.journal.parked.update(summaries)
+        logger.info(
+            f"[memorychain] 从聊天日志恢复{len(sessions)}个会话,{message_count}条消息,"
+            f"{len(self.journal.parked)}个会话留在日志中,耗时{(time.perf_counter() - start) * 1000:.1f}ms"
+        )
 
     @filter.command_group("memorychain")
     def memorychain(self):
@@ -155,6 +378,117 @@ class memorychain(Star):
         await self._save_data()
         yield event.plain_result(f"成功设置编码器为{self.ep_name}")
 
+    @memorychain.command("mem")
+    async def get_memory_usage(self, event: AstrMessageEvent):
+        """查看会话缓冲区的内存占用"""
+        session_count = len(self.compressor.compressed_chats)
+        usage = self.compressor.memory_usage()
+        per_session = usage // session_count if session_count else 0
+        compressions = self.compressor.compressions
+        avg_tokens = self.compressor.prompt_tokens // compressions if compressions else 0
+        outputtext = (
+            f"会话数:{session_count}/{self.compressor.max_sessions}, 占用约{usage / 1024:.1f}KB, 平均每会话{per_session}B\n"
+            f"压缩次数:{compressions}, 共发送约{self.compressor.prompt_tokens}个token, 平均每次{avg_tokens}个token"
+        )
+        yield event.plain_result(outputtext)
+        logger.info(f"[memorychain] {outputtext}")
+
+    @memorychain.command("stats")
+    async def get_stats(self, event: AstrMessageEvent, session_id: str = ""):
+        """查看各阶段耗时与计数,指定session_id时查看单个会话"""
+        if session_id:
+            outputtext = self.metrics.render_session(session_id.strip())
+        else:
+            outputtext = self.metrics.render_text(self._metric_gauges())
+        yield event.plain_result(outputtext)
+        logger.info(f"[memorychain] {outputtext}")
+
+    def _metric_gauges(self) -> dict[str, float]:
+        """各组件的当前状态,随统计一起输出"""
+        return {
+            "sessions": len(self.compressor.compressed_chats),
+            "session_buffer_bytes": self.compressor.memory_usage(),
+            "sessions_evicted": self.compressor.evicted,
+            "sessions_parked_in_journal": len(self.journal.parked) if self.journal else 0,
+            "compress_prompt_tokens": self.compressor.prompt_tokens,
+            "compress_queue_size": self.compress_pool.queue.qsize() if self.compress_pool.queue else 0,
+            "compress_pending": len(self.compress_pool.pending),
+            "compress_dropped": self.compress_pool.dropped,
+            "retrieval_cache_hits": self.retrieval_cache.hits,
+            "retrieval_cache_misses": self.retrieval_cache.misses,
+            "kb_handle_cache_hits": self.kb_handles.hits,
+            "kb_handle_cache_misses": self.kb_handles.misses,
+            "llm_breakers_open": self.llm_client.open_breakers() if self.llm_client else 0,
+            "compaction_llm_breakers_open": self.compaction_llm.open_breakers() if self.compaction_llm else 0,
+            "data_writes": self.data_writer.writes,
+            "data_writes_skipped": self.data_writer.skipped,
+        }
+
+    async def _export_metrics_loop(self):
+        """定期把统计写成Prometheus文本格式文件"""
+        interval = float(self.Config.get("metrics_export_interval", 0))
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await asyncio.to_thread(write_text_atomic, self.metrics_file, self.metrics.render_prometheus(self._metric_gauges()))
+            except Exception as e:
+                logger.error(f"[memorychain] 导出统计失败: {e}")
+
+    @memorychain.command("compact")
+    async def compact_kbs(self, event: AstrMessageEvent, kb_name: str = ""):
+        """立即在后台整理记忆数据库,不指定kb_name时整理所有记忆链数据库"""
+        if self.compactor.running or (self._manual_compaction_task is not None and not self._manual_compaction_task.done()):
+            yield event.plain_result("记忆整理正在进行中")
+            return
+        kb_helpers = self._memory_kbs()
+        if kb_name:
+            kb_helpers = [kb_helper for kb_helper in kb_helpers if kb_helper.kb.kb_name == kb_name]
+            if not kb_helpers:
+                yield event.plain_result(f"kb:{kb_name} 不存在")
+                return
+        self._manual_compaction_task = asyncio.create_task(self._compact_once(kb_helpers))
+        yield event.plain_result(f"开始整理{len(kb_helpers)}个记忆数据库")
+
+    def _memory_kbs(self) -> list[KBHelper]:
+        return [
+            kb_helper for kb_helper in self.context.kb_manager.kb_insts.values()
+            if kb_helper.kb.kb_name.endswith("记忆链") and kb_helper.kb.kb_name not in self._migrating
+        ]
+
+    async def _compact(self, kb_helpers: list[KBHelper]):
+        with self.metrics.timer("compaction"):
+            merged, created, deleted = await self.compactor.run(kb_helpers)
+        self.metrics.inc("compaction_merged_docs", value = merged)
+        self.metrics.inc("compaction_created_docs", value = created)
+        self.metrics.inc("compaction_deleted_docs", value = deleted)
+        logger.info(f"[memorychain] 记忆整理完成: {len(kb_helpers)}个数据库,合并{merged}个文档为{created}份摘要,删除{deleted}个文档")
+
+    async def _compact_once(self, kb_helpers: list[KBHelper]):
+        try:
+            await self._compact(kb_helpers)
+        except Exception as e:
+            logger.error(f"[memorychain] 记忆整理失败: {e}")
+
+    async def _compaction_loop(self):
+        """定期整理记忆数据库"""
+        interval = float(self.Config.get("compaction_interval", 0))
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self._compact(self._memory_kbs())
+            except Exception as e:
+                logger.error(f"[memorychain] 记忆整理失败: {e}")
+
+    async def _compaction_summarize(self, prompt: str) -> str:
+        if self.compaction_llm is None:
+            raise RuntimeError("没有配置llm_name,无法合并记忆")
+        with self.metrics.timer("compaction_summary"):
+            return await self.compaction_llm.generate_text(prompt)
+
+    def _on_memory_removed(self, kb_name: str, doc_id: str):
+        self.fingerprints.remove_doc(kb_name, doc_id)
+        self.retrieval_cache.invalidate(kb_name)
+
     @memorychain.command("kbn")
     async def get_kb_name(self, event: AstrMessageEvent):
         """获取所有数据库"""
@@ -202,19 +536,21 @@ class memorychain(Star):
     @memorychain.command("kbcr")
     async def kb_create(self, event: AstrMessageEvent, kb_name: str, ep_names: str):
         """创建数据库"""
-        await self.context.kb_manager.create_kb(
+        kb_helper = await self.context.kb_manager.create_kb(
             kb_name = kb_name,
             embedding_provider_id = ep_names
         )
+        self.kb_handles.set(kb_name, kb_helper)
         yield event.plain_result(f"成功创建数据库:{kb_name}")
         logger.info(f"[memorychain] 成功创建数据库:{kb_name}")
 
     @memorychain.command("kbcr_cs")
     async def kb_create_cs(self, event: AstrMessageEvent, kb_name: str):
         """创建数据库(测试版本)"""
-        await self.context.kb_manager.create_kb(
+        kb_helper = await self.context.kb_manager.create_kb(
             kb_name = kb_name
         )
+        self.kb_handles.set(kb_name, kb_helper)
         yield event.plain_result(f"成功创建数据库:{kb_name}")
         logger.info(f"[memorychain] 成功创建数据库:{kb_name}")
 
@@ -235,6 +571,9 @@ class memorychain(Star):
             kb = await self.context.kb_manager.kb_db.get_kb_by_name(db_name)
             await session.delete(kb)
             await session.commit()
+        self.retrieval_cache.invalidate(db_name)
+        self.kb_handles.invalidate(db_name)
+        self.fingerprints.drop_kb(db_name)
         yield event.plain_result(f"成功删除db数据库:{db_name}")
         logger.info(f"成功删除db数据库:{db_name}")
 
@@ -245,18 +584,187 @@ class memorychain(Star):
         if not kb_helper:
             yield event.plain_result(f"kb:{kb_name} 不存在")
             return
-        kb_id = kb_helper.kb.kb_id
+        await self._delete_kb(kb_helper)
+        yield event.plain_result(f"kb:{kb_name} 成功删除")
+
+    async def _delete_kb(self, kb_helper: KBHelper):
+        """删除数据库的向量库与记录,并清除相关缓存"""
+        kb_name = kb_helper.kb.kb_name
         await kb_helper.delete_vec_db()
         async with self.context.kb_manager.kb_db.get_db() as session:
             await session.delete(kb_helper.kb)
             await session.commit()
-        self.context.kb_manager.kb_insts.pop(kb_id, None)
-        yield event.plain_result(f"kb:{kb_name} 成功删除")
+        self.context.kb_manager.kb_insts.pop(kb_helper.kb.kb_id, None)
+        self.retrieval_cache.invalidate(kb_name)
+        self.kb_handles.invalidate(kb_name)
+        self.fingerprints.drop_kb(kb_name)
+
+    @memorychain.command("export")
+    async def export_kbs(self, event: AstrMessageEvent, kb_name: str = ""):
+        """把记忆数据库导出为JSONL文件,不指定kb_name时导出所有记忆链数据库,中断后再次执行会继续导出"""
+        kb_helpers = self._memory_kbs()
+        if kb_name:
+            kb_helpers = [kb_helper for kb_helper in self.context.kb_manager.kb_insts.values() if kb_helper.kb.kb_name == kb_name]
+            if not kb_helpers:
+                yield event.plain_result(f"kb:{kb_name} 不存在")
+                return
+        os.makedirs(self.export_dir, exist_ok = True)
+
+        async def export():
+            for kb_helper in kb_helpers:
+                path = os.path.join(self.export_dir, f"{kb_helper.kb.kb_name}.jsonl")
+                count = await self.migrator.export_kb(kb_helper, path)
+                logger.info(f"[memorychain] 已导出{kb_helper.kb.kb_name}的{count}个文档到{path}")
+
+        yield event.plain_result(self._start_migration(export(), f"导出{len(kb_helpers)}个数据库到{self.export_dir}"))
+
+    @memorychain.command("import")
+    async def import_kb(self, event: AstrMessageEvent, file_name: str, kb_name: str):
+        """把JSONL文件中的文档导入到数据库并重新嵌入,数据库不存在时自动创建,中断后再次执行会继续导入"""
+        path = file_name if os.path.isabs(file_name) else os.path.join(self.export_dir, file_name)
+        if not os.path.exists(path):
+            yield event.plain_result(f"文件{path}不存在")
+            return
+
+        async def import_file():
+            kb_helper = await self._get_or_create_memory_kb(kb_name)
+            count = await self.migrator.import_file(path, kb_helper)
+            logger.info(f"[memorychain] 已从{path}导入{count}个文档到{kb_name}")
+
+        yield event.plain_result(self._start_migration(import_file(), f"从{path}导入到{kb_name}"))
+
+    @memorychain.command("reembed")
+    async def reembed_kbs(self, event: AstrMessageEvent, kb_name: str, ep_name: str):
+        """用新的编码器重新嵌入记忆数据库,kb_name为all时迁移所有记忆链数据库,中断后再次执行会继续迁移"""
+        if not isinstance(self.context.get_provider_by_id(ep_name), EmbeddingProvider):
+            yield event.plain_result(f"编码器{ep_name}不存在")
+            return
+
+        def select() -> list[KBHelper]:
+            if kb_name == "all":
+                return [kb_helper for kb_helper in self._memory_kbs() if kb_helper.kb.embedding_provider_id != ep_name]
+            return [kb_helper for kb_helper in self.context.kb_manager.kb_insts.values() if kb_helper.kb.kb_name == kb_name]
+
+        names = {kb_helper.kb.kb_name for kb_helper in self.context.kb_manager.kb_insts.values()}
+        # 上次切换中断时数据库暂时只有备份名称,由迁移任务中的恢复步骤改回原名称
+        if kb_name != "all" and kb_name not in names and f"{kb_name}_迁移前" not in names:
+            yield event.plain_result(f"kb:{kb_name} 不存在")
+            return
+
+        async def reembed():
+            # 在迁移任务中恢复中断的切换,同时只有一个迁移,不会改动正在切换的数据库
+            await self._recover_reembeds()
+            kb_helpers = select()
+            if not kb_helpers and kb_name != "all":
+                raise RuntimeError(f"kb:{kb_name} 不存在")
+            for kb_helper in kb_helpers:
+                await self._reembed_kb(kb_helper, ep_name)
+
+        yield event.plain_result(self._start_migration(reembed(), f"使用{ep_name}重新嵌入{'所有记忆链' if kb_name == 'all' else kb_name}数据库"))
+
+    def _start_migration(self, job: Awaitable[None], description: str) -> str:
+        """在后台执行迁移,同时只允许一个迁移"""
+        if self._migration_task is not None and not self._migration_task.done():
+            job.close()
+            return "已有导出/导入/重新嵌入任务在进行中"
+
+        async def run():
+            try:
+                with self.metrics.timer("migration"):
+                    await job
+                logger.info(f"[memorychain] {description}完成")
+            except Exception as e:
+                logger.error(f"[memorychain] {description}失败,再次执行同一命令可从断点继续: {e}")
+
+        self._migration_task = asyncio.create_task(run())
+        return f"开始{description},完成后记录在日志中"
+
+    async def _reembed_kb(self, kb_helper: KBHelper, ep_name: str):
+        """复制到使用新编码器的临时数据库,完成后删除旧数据库并把临时数据库改为原名称"""
+        kb_name = kb_helper.kb.kb_name
+        target_name = f"{kb_name}_迁移中"
+        checkpoint_name = f"reembed_{kb_name}"
+        target: KBHelper | None = await self.context.kb_manager.get_kb_by_name(target_name)
+        if target is not None and (target.kb.embedding_provider_id != ep_name or not self.migrator.has_checkpoint(checkpoint_name)):
+            # 上次迁移使用了别的编码器或没有留下断点,无法判断临时数据库中的内容,重新开始
+            await self._delete_kb(target)
+            target = None
+        if target is None:
+            self.migrator.checkpoint(checkpoint_name).remove()
+            target = await self.context.kb_manager.create_kb(kb_name = target_name, embedding_provider_id = ep_name)
+        self._migrating.add(kb_name)
+        try:
+            count = await self.migrator.copy_kb(kb_helper, target, checkpoint_name)
+            # 持有锁期间该数据库的压缩任务等待,不会写入即将删除的旧数据库,也不会自动新建同名数据库
+            async with self._kb_lock(kb_name):
+                count += await self.migrator.copy_new_documents(kb_helper, target, checkpoint_name)
+                # 先把旧数据库改为备份名称,再把临时数据库改为原名称,进程中断后由_recover_reembeds完成切换
+                await self.context.kb_manager.update_kb(kb_id = kb_helper.kb.kb_id, kb_name = f"{kb_name}_迁移前")
+                self.kb_handles.invalidate(kb_name)
+                try:
+                    await self.context.kb_manager.update_kb(kb_id = target.kb.kb_id, kb_name = kb_name)
+                except Exception:
+                    # 改名失败时换回旧数据库,下次执行时从断点继续
+                    await self.context.kb_manager.update_kb(kb_id = kb_helper.kb.kb_id, kb_name = kb_name)
+                    raise
+                await self._delete_kb(kb_helper)
+                self._swapped(kb_name, target)
+            self.migrator.finish(checkpoint_name)
+        finally:
+            self._migrating.discard(kb_name)
+        self.metrics.inc("reembedded_docs", value = count)
+        logger.info(f"[memorychain] {kb_name}已使用{ep_name}重新嵌入{count}个文档")
+
+    def _swapped(self, kb_name: str, kb_helper: KBHelper):
+        """数据库换成了重新嵌入后的副本,旧的句柄、检索结果与指纹都已失效"""
+        self.kb_handles.set(kb_name, kb_helper)
+        self.retrieval_cache.invalidate(kb_name)
+        self.fingerprints.drop_kb(kb_name)
+
+    def _kb_lock(self, kb_name: str):
+        return self._kb_locks.hold(kb_name)
+
+    async def _recover_reembeds(self):
+        """完成上次在切换阶段中断的重新嵌入: 临时数据库改为原名称,删除备份"""
+        kb_manager = self.context.kb_manager
+        by_name = {kb_helper.kb.kb_name: kb_helper for kb_helper in list(kb_manager.kb_insts.values())}
+        for name, kb_helper in list(by_name.items()):
+            if name.endswith("_迁移前"):
+                kb_name = name[:-len("_迁移前")]
+                target = by_name.get(f"{kb_name}_迁移中")
+                if kb_name not in by_name:
+                    # 原名称空缺: 复制已完成(断点仍在)时把临时数据库改为原名称,否则恢复备份
+                    if target is not None and self.migrator.has_checkpoint(f"reembed_{kb_name}"):
+                        restored = target
+                    else:
+                        restored = kb_helper
+                    await kb_manager.update_kb(kb_id = restored.kb.kb_id, kb_name = kb_name)
+                    by_name[kb_name] = restored
+                    self._swapped(kb_name, restored)
+                elif target is not None:
+                    # 原名称与临时数据库同时存在,无法判断哪个是完整的数据,保留现场
+                    logger.warning(f"[memorychain] {kb_name}、{name}与{kb_name}_迁移中同时存在,请手动检查后删除多余的数据库")
+                    continue
+                if by_name[kb_name] is not kb_helper:
+                    await self._delete_kb(kb_helper)
+                self.migrator.finish(f"reembed_{kb_name}")
+                logger.info(f"[memorychain] 已完成{kb_name}中断的重新嵌入切换")
+            elif name.endswith("_迁移中"):
+                kb_name = name[:-len("_迁移中")]
+                if kb_name not in by_name and f"{kb_name}_迁移前" not in by_name:
+                    # 旧数据库已经删除,数据只在临时数据库中
+                    await kb_manager.update_kb(kb_id = kb_helper.kb.kb_id, kb_name = kb_name)
+                    by_name[kb_name] = kb_helper
+                    self._swapped(kb_name, kb_helper)
+                    self.migrator.finish(f"reembed_{kb_name}")
+                    logger.info(f"[memorychain] 已把孤立的临时数据库{name}恢复为{kb_name}")
 
     @memorychain.command("reloadkbs")
     async def re_load_kbs(self, event: AstrMessageEvent):
         """重新加载所有数据库,防止错误操作导致的数据库检测不到"""
         await self.context.kb_manager.load_kbs()
+        self.retrieval_cache.clear()
+        self.kb_handles.clear()
         yield event.plain_result(f"成功重新加载所有数据库")
         logger.info(f"成功重新加载所有数据库")
 
@@ -265,36 +773,81 @@ class memorychain(Star):
         """在LLM请求前添加压缩后的上下文"""
         if not self.enabled:
             return
-        group_id = str(event.get_group_id())
+        session_id, kb_name, is_private = self._session_of(event)
         sender_id = str(event.get_sender_id())
         nickname = str(event.get_sender_name())
         user_message = event.message_str.strip()
-        is_private = group_id is None
-        if is_private:
-            await self.compressor.add_message(sender_id, f"{nickname}({sender_id})", user_message, self.llm_fun, is_user = True)
-        else:
-            await self.compressor.add_message(group_id, f"{nickname}({sender_id})", user_message, self.llm_fun, is_user = True)
-        if is_private:
-            kb_name = f"私聊{group_id}记忆链"
+        await self._buffer_message(session_id, f"{nickname}({sender_id})", user_message, kb_name)
+        # 群记忆、发言人的个人记忆与全局记忆并发检索,总耗时取决于最慢的一个
+        scopes = {"group": kb_name}
+        if self.Config.get("retrieve_personal_scope", 0) == 1 and not is_private:
+            scopes["personal"] = f"私聊{sender_id}记忆链"
+        global_kb_name = self.Config.get("global_kb_name", "")
+        if global_kb_name and global_kb_name not in scopes.values():
+            scopes["global"] = global_kb_name
+        # 过短、纯表情、语气词、指令或与上一条几乎相同的消息不做向量检索
+        # 结果中含有发言人的个人记忆时按发言人区分,不把一个人的记忆复用给群里的其他人
+        gate_key = f"{session_id}:{sender_id}" if "personal" in scopes else session_id
+        decision, reused = self.retrieval_gate.check(gate_key, user_message)
+        if decision != "pass":
+            self.metrics.inc(f"gate_{decision}", session_id)
+            # 只按缓存中的句柄计数,跳过检索时不再为统计去查找数据库
+            saved = sum(1 for scope_kb_name in scopes.values() if self.kb_handles.peek(scope_kb_name) is not None)
+            self.metrics.inc("gate_saved_searches", session_id, saved)
+            results_dict = reused or []
         else:
-            kb_name = f"群{group_id}记忆链"
-        kb_helper: KBHelper | None = await self.context.kb_manager.get_kb_by_name(kb_name)
-        if kb_helper is None:
+            with self.metrics.timer("retrieve", session_id):
+                scope_results = await asyncio.gather(*(
+                    self._retrieve_scope(scope, scope_kb_name, user_message, session_id)
+                    for scope, scope_kb_name in scopes.items()
+                ))
+            results_dict = [result for results in scope_results for result in results]
+            self.retrieval_gate.remember(gate_key, user_message, results_dict)
+        if not results_dict:
             return
-        else:
-            relative_memory = []
-            results = await self.context.kb_manager.retrieve(
-                query = user_message,
-                kb_names = [kb_name]
-            )
-            results_dict = results["results"]
-            for result in results_dict:
-                doc_name = result.get("doc_name","")
-                context = result.get("content","")
-                relative_memory.append(f"{doc_name}:\n{context}")
+        relative_memory, tokens = self.context_selector.select(results_dict)
+        logger.debug(f"[memorychain] {'/'.join(scopes.values())}检索到{len(results_dict)}条记忆,注入{len(relative_memory)}条,约{tokens}个token")
+        if not relative_memory:
+            return
+        self.metrics.inc("retrieval_hits", session_id)
+        self.metrics.inc("injected_chunks", session_id, len(relative_memory))
+        self.metrics.inc("injected_tokens", session_id, tokens)
         system_prompt = f'This following message is relative context for your response:\n\n{chr(10).join(relative_memory)}'
         req.system_prompt += system_prompt
 
+    async def _retrieve_scope(self, scope: str, kb_name: str, query: str, session_id: str) -> list[dict]:
+        """检索单个记忆数据库,超时或出错时返回空列表,不影响其他范围"""
+        with self.metrics.timer("kb_lookup", session_id):
+            kb_helper: KBHelper | None = await self.kb_handles.get(kb_name)
+        if kb_helper is None:
+            return []
+        results = self.retrieval_cache.get(kb_name, query)
+        if results is not None:
+            self.metrics.inc("retrieval_cache_hits", session_id)
+            return results.get("results", [])
+        generation = self.retrieval_cache.generation(kb_name)
+        timeout = float(self.Config.get(f"retrieve_{scope}_timeout", 3))
+        try:
+            with self.metrics.timer(f"retrieve_{scope}", session_id):
+                results = await asyncio.wait_for(
+                    self.context.kb_manager.retrieve(
+                        query = query,
+                        kb_names = [kb_name],
+                        # 多取一些候选,留给分数过滤与去重
+                        top_m_final = self.context_selector.top_k * 2
+                    ),
+                    timeout if timeout > 0 else None
+                ) or {}
+        except asyncio.TimeoutError:
+            self.metrics.inc("retrieve_timeouts", session_id)
+            logger.warning(f"[memorychain] 检索{kb_name}超过{timeout}秒,本次跳过")
+            return []
+        except Exception as e:
+            logger.error(f"[memorychain] 检索{kb_name}失败: {e}")
+            return []
+        self.retrieval_cache.put(kb_name, query, results, generation)
+        return results.get("results", [])
+
     @filter.on_llm_response()
     async def on_llm_response(self, event: AstrMessageEvent, req: LLMResponse):
         """在LLM响应后添加助手消息到历史"""
@@ -302,63 +855,241 @@ class memorychain(Star):
             return
         if not self.enabled:
             return
-        group_id = str(event.get_group_id())
-        sender_id = str(event.get_sender_id())
-        is_private = group_id is None
+        session_id, kb_name, _ = self._session_of(event)
         # LLM返回的消息
         assistant_response = req.completion_text.strip()
         # 添加LLM的聊天记录
-        if is_private:
-            bot_name = self.bot_name.get(sender_id, "assistant")
-            summary = await self.compressor.add_message(sender_id, f"{bot_name}", assistant_response, self.llm_fun)
-        else:
-            bot_name = self.bot_name.get(group_id, "assistant")
-            summary = await self.compressor.add_message(group_id, f"{bot_name}", assistant_response, self.llm_fun)
-        if summary:
-            if is_private:
-                kb_name = f"私聊{group_id}记忆链"
-                file_name = f"私聊{group_id}_{time.strftime('%Y年%m月%d日', time.localtime())}"
-            else:
-                kb_name = f"群{group_id}记忆链"
-                file_name = f"群{group_id}_{time.strftime('%Y年%m月%d日', time.localtime())}"
-            kb_helper: KBHelper | None = await self.context.kb_manager.get_kb_by_name(kb_name)
-            if kb_helper is None:
-                if self.ep_name is None:
-                    p_ids = list(self.context.provider_manager.inst_map.keys())
-                    for p_id in p_ids:
-                        providers = self.context.get_provider_by_id(p_id)
-                        if isinstance(providers, EmbeddingProvider):
-                            ep_name = p_id
-                            break
-                    else:
-                        raise RuntimeError("astrbot系统没有实例化的embeddingprovider,存储记忆失败")
-                else:
-                    ep_name = self.ep_name
-                kb_helper = await self.context.kb_manager.create_kb(
-                    kb_name = kb_name,
-                    embedding_provider_id = ep_name
-                )
-                logger.info(f"创建数据库:{kb_name}")
-            await self.upload_memory(
-                kb_helper = kb_helper,
-                file_name = file_name,
-                pre_chunked_text = [summary],
-                file_type = "txt",
-                file_content = None
-            )
-            if is_private:
-                await self.compressor.del_message(sender_id)
+        bot_name = self.bot_name.get(session_id, "assistant")
+        chat = await self._buffer_message(session_id, f"{bot_name}", assistant_response, kb_name)
+        # 确保在AI回复时才进行压缩,同一会话同时只允许一个压缩任务
+        if not self.compressor.need_compress(session_id) or self.compress_pool.is_pending(session_id):
+            return
+        if self.llm_fun is None:
+            raise ValueError("llm_fun没有被设置")
+        journal_seq = chat.last_seq
+        previous_summary = chat.summary
+        await self._submit_compression(session_id, kb_name, self.compressor.take_snapshot(session_id), journal_seq, previous_summary)
+
+    @staticmethod
+    def _session_of(event: AstrMessageEvent) -> tuple[str, str, bool]:
+        """返回(会话id, 记忆数据库名称, 是否私聊),私聊按发送者区分,群聊按群号区分"""
+        group_id = event.get_group_id()
+        if not group_id:
+            sender_id = str(event.get_sender_id())
+            return sender_id, f"私聊{sender_id}记忆链", True
+        return str(group_id), f"群{group_id}记忆链", False
+
+    async def _buffer_message(self, session_id: str, role: str, content: str, kb_name: str) -> "CompressedChat":
+        """把消息加入会话缓冲区并追加到日志"""
+        if self.journal is not None and session_id in self.journal.parked:
+            await self._reload_session(session_id, kb_name)
+        chat = await self.compressor.add_message(session_id, role, content, kb_name)
+        self.metrics.inc("messages_buffered", session_id)
+        if self.journal is not None:
+            chat.last_seq = self.journal.append(session_id, kb_name, chat.recent_messages[-1])
+        return chat
+
+    async def _submit_compression(self, session_id: str, kb_name: str, messages: list[str], journal_seq: int = 0, previous_summary: str = ""):
+        """把会话快照提交到后台压缩任务池,提交失败时放回缓冲区"""
+        job = CompressionJob(
+            session_id = session_id,
+            kb_name = kb_name,
+            file_name = f"{kb_name.removesuffix('记忆链')}_{time.strftime('%Y年%m月%d日', time.localtime())}",
+            messages = messages,
+            journal_seq = journal_seq,
+            previous_summary = previous_summary
+        )
+        if not await self.compress_pool.submit(job):
+            self._restore_or_park(session_id, job.messages, journal_seq)
+            return
+        self.metrics.inc("compressions_submitted", session_id)
+
+    async def _on_session_evicted(self, session_id: str, chat: "CompressedChat"):
+        """会话被淘汰时,缓冲消息足够多就提交压缩,否则只释放内存,消息留在日志中等会话再次活跃时载入"""
+        # 队列已满时不提交,否则丢弃的旧任务会放回缓冲区,淘汰循环永远结束不了
+        if (
+            len(chat.recent_messages) >= int(self.Config.get("evict_flush_min", 10))
+            and self.llm_fun is not None
+            and not self.compress_pool.is_pending(session_id)
+            and not self.compress_pool.is_full()
+        ):
+            if self.journal is not None:
+                self.journal.forget_summary(session_id)
+            await self._submit_compression(session_id, chat.kb_name, list(chat.recent_messages), chat.last_seq, chat.summary)
+            return
+        self._park(session_id, len(chat.recent_messages), chat.last_seq)
+
+    def _park(self, session_id: str, message_count: int, journal_seq: int):
+        """释放会话的内存,消息留在日志中等会话再次活跃时载入;没有日志时丢弃"""
+        if self.journal is not None and journal_seq:
+            self.journal.park(session_id)
+            self.metrics.inc("sessions_parked")
+            logger.debug(f"[memorychain] 会话{session_id}被淘汰,{message_count}条消息留在日志中")
+            return
+        self.metrics.inc("sessions_discarded")
+        logger.warning(f"[memorychain] 会话{session_id}被淘汰,{message_count}条未压缩消息被丢弃")
+
+    def _restore_or_park(self, session_id: str, messages: list[str], journal_seq: int):
+        """未能压缩的快照放回仍在内存中的会话;会话已被淘汰时不重新创建,以免超出max_sessions后反复淘汰"""
+        if not self.compressor.restore(session_id, messages, journal_seq):
+            self._park(session_id, len(messages), journal_seq)
+
+    async def _reload_session(self, session_id: str, kb_name: str):
+        """被淘汰的会话再次活跃时,从日志重新载入留下的消息与滚动摘要"""
+        # 压缩任务执行中时日志里还有快照中的消息,等任务结束后再载入,避免重复压缩
+        if self.compress_pool.is_pending(session_id):
+            return
+        self.journal.parked.discard(session_id)
+        try:
+            loaded = await self.journal.load_session(session_id)
+        except Exception as e:
+            logger.error(f"[memorychain] 从聊天日志载入会话{session_id}失败: {e}")
+            self.journal.parked.add(session_id)
+            return
+        if loaded is None:
+            return
+        if self.compress_pool.is_pending(session_id):
+            self.journal.parked.add(session_id)
+            return
+        lines, last_seq, summary = loaded
+        self.compressor.reload_session(session_id, kb_name, lines, last_seq, summary)
+        self.metrics.inc("sessions_reloaded", session_id)
+
+    def _truncate_journal(self, session_id: str, journal_seq: int):
+        if self.journal is not None and journal_seq:
+            self.journal.truncate(session_id, journal_seq)
+
+    async def _sweep_loop(self):
+        """定期淘汰空闲会话"""
+        interval = max(1.0, min(self.compressor.idle_timeout / 2, 60.0))
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.compressor.evict_idle()
+            except Exception as e:
+                logger.error(f"[memorychain] 淘汰空闲会话失败: {e}")
+
+    async def _run_compression_job(self, job: "CompressionJob"):
+        """后台执行一次压缩: 总结快照并上传到记忆数据库"""
+        with self.metrics.timer("llm_summary", job.session_id):
+            summary = await self.llm_fun(self.compressor.build_prompt(job.messages, job.previous_summary))
+        if not summary:
+            raise ValueError(f"会话{job.session_id}的总结为空")
+        # 重新嵌入切换数据库期间等待,切换完成后写入新的数据库
+        async with self._kb_lock(job.kb_name):
+            await self._store_summary(job, summary)
+
+    async def _store_summary(self, job: "CompressionJob", summary: str):
+        kb_helper = await self._get_or_create_memory_kb(job.kb_name)
+        # 与最近的记忆几乎相同时跳过上传,或合并进已有的记忆
+        memory_text = summary
+        fingerprint = simhash64(summary)
+        replaced_doc_id = ""
+        duplicate = self.fingerprints.find(job.kb_name, fingerprint)
+        if duplicate is not None:
+            self.metrics.inc("dedup_hits", job.session_id)
+            merged = await self._merge_duplicate(kb_helper, duplicate, summary)
+            if merged is None:
+                self._finish_compression(job, summary)
+                return
+            memory_text, replaced_doc_id = merged
+            fingerprint = simhash64(memory_text)
+        try:
+            doc = await self.upload_memory(kb_helper, job.file_name, [memory_text])
+        except Exception:
+            self.metrics.inc("upload_failures", job.session_id)
+            raise
+        self.fingerprints.add(job.kb_name, fingerprint, doc.doc_id, doc.chunk_count)
+        if replaced_doc_id:
+            # 合并后的记忆上传成功,删除旧记忆
+            try:
+                await kb_helper.delete_document(replaced_doc_id)
+                self.fingerprints.remove_doc(job.kb_name, replaced_doc_id)
+                self.retrieval_cache.invalidate(job.kb_name)
+                self.metrics.inc("dedup_merged", job.session_id)
+            except Exception as e:
+                logger.warning(f"[memorychain] 删除被合并的记忆{replaced_doc_id}失败: {e}")
+        self._finish_compression(job, summary)
+
+    async def _merge_duplicate(self, kb_helper: KBHelper, duplicate: list, summary: str) -> tuple[str, str] | None:
+        """merge模式下把新摘要中没有出现过的句子并入旧记忆,返回(合并后的文本, 被替换的文档id);不合并时返回None"""
+        _, doc_id, items = duplicate
+        if self.Config.get("dedup_action", "skip") != "merge" or items != 1:
+            return None
+        try:
+            chunks = await kb_helper.get_chunks_by_doc_id(doc_id, offset = 0, limit = 1)
+        except Exception as e:
+            logger.warning(f"[memorychain] 读取重复记忆{doc_id}失败,跳过合并: {e}")
+            return None
+        if not chunks:
+            return None
+        merged = merge_summaries(chunks[0].get("content", ""), summary)
+        if merged is None:
+            return None
+        return merged, doc_id
+
+    def _finish_compression(self, job: "CompressionJob", summary: str):
+        self.metrics.inc("compressions", job.session_id)
+        # 上传成功后才截断日志,失败的快照在下次压缩或重启后仍可恢复
+        self._truncate_journal(job.session_id, job.journal_seq)
+        # 滚动模式下保存摘要,下次压缩只发送新增消息
+        if self.compressor.set_summary(job.session_id, summary) and self.journal is not None:
+            self.journal.set_summary(job.session_id, job.kb_name, summary)
+
+    def _on_compression_failed(self, job: "CompressionJob", reason: str):
+        """压缩任务失败或被丢弃时,把快照放回会话缓冲区,等待下次压缩"""
+        self.metrics.inc("compression_failures", job.session_id)
+        self._restore_or_park(job.session_id, job.messages, job.journal_seq)
+        logger.warning(f"[memorychain] 会话{job.session_id}的压缩任务{reason},消息已放回缓冲区或日志")
+
+    async def _get_or_create_memory_kb(self, kb_name: str) -> KBHelper:
+        """获取记忆数据库,不存在时使用配置的编码器自动创建"""
+        kb_helper: KBHelper | None = await self.kb_handles.get(kb_name)
+        if kb_helper is not None:
+            return kb_helper
+        if self.ep_name is None:
+            p_ids = list(self.context.provider_manager.inst_map.keys())
+            for p_id in p_ids:
+                providers = self.context.get_provider_by_id(p_id)
+                if isinstance(providers, EmbeddingProvider):
+                    ep_name = p_id
+                    break
             else:
-                await self.compressor.del_message(group_id)
+                raise RuntimeError("astrbot系统没有实例化的embeddingprovider,存储记忆失败")
+        else:
+            ep_name = self.ep_name
+        kb_helper = await self.context.kb_manager.create_kb(
+            kb_name = kb_name,
+            embedding_provider_id = ep_name
+        )
+        self.kb_handles.set(kb_name, kb_helper)
+        logger.info(f"创建数据库:{kb_name}")
+        return kb_helper
 
     async def _set_llm(self, provider_id: str):
-        async def llm_fun(text):
+        async def generate(chat_provider_id: str, text: str) -> str:
             llm_resp = await self.context.llm_generate(
-                chat_provider_id=provider_id,  # 聊天模型 ID
+                chat_provider_id=chat_provider_id,  # 聊天模型 ID
                 prompt=text,
             )
             return llm_resp.completion_text
-        self.llm_fun = llm_fun
+        # 主提供商之后依次是备用提供商,每个提供商单独超时与熔断
+        fallbacks = [p_id.strip() for p_id in str(self.Config.get("llm_fallback_providers", "")).split(",") if p_id.strip()]
+
+        def build(prefix: str) -> FailoverLLM:
+            return FailoverLLM(
+                generate = generate,
+                providers = [provider_id] + [p_id for p_id in fallbacks if p_id != provider_id],
+                timeout = float(self.Config.get("llm_timeout", 60)),
+                hedge_delay = float(self.Config.get("llm_hedge_delay", 0)),
+                failure_threshold = int(self.Config.get("llm_breaker_failures", 3)),
+                cooldown = float(self.Config.get("llm_breaker_cooldown", 60)),
+                on_event = lambda name: self.metrics.inc(f"{prefix}{name}")
+            )
+        self.llm_client = build("llm_")
+        self.llm_fun = self.llm_client.generate_text
+        # 记忆整理的长提示词单独熔断,失败不影响聊天压缩
+        self.compaction_llm = build("compaction_llm_")
 
     async def upload_memory_by_kb_name(
             self,
@@ -388,23 +1119,26 @@ class memorychain(Star):
             pre_chunked_text: list[str],        # 切割好的文本块
             file_type: str = "txt",            # 默认采用txt格式上传
             file_content: bytes | None = None,  # 如果为文件传输
-    ):
+    ) -> KBDocument:
         chunk_size = int(self.Config.get("chunk_size", 512))
         chunk_overlap = int(self.Config.get("chunk_overlap", 50))
         batch_size = int(self.Config.get("batch_size", 32))
         tasks_limit = int(self.Config.get("tasks_limit", 3))
         max_retries = int(self.Config.get("max_retries", 3))
-        await kb_helper.upload_document(
-            file_name = file_name,
-            file_content = file_content,
-            file_type = file_type,
-            chunk_size = chunk_size,
-            chunk_overlap = chunk_overlap,
-            batch_size = batch_size,
-            tasks_limit = tasks_limit,
-            max_retries = max_retries,
-            pre_chunked_text = pre_chunked_text
-        )
+        with self.metrics.timer("upload_document"):
+            doc = await kb_helper.upload_document(
+                file_name = file_name,
+                file_content = file_content,
+                file_type = file_type,
+                chunk_size = chunk_size,
+                chunk_overlap = chunk_overlap,
+                batch_size = batch_size,
+                tasks_limit = tasks_limit,
+                max_retries = max_retries,
+                pre_chunked_text = pre_chunked_text
+            )
+        self.retrieval_cache.invalidate(kb_helper.kb.kb_name)
+        return doc
 
     async def get_all_kbs(self, db: KBSQLiteDatabase) -> list[KnowledgeBase]:
         """获取所有知识库"""
@@ -421,51 +1155,1601 @@ class memorychain(Star):
             offset += batch_size
         return all_kbs
 
-@dataclass
+def estimate_tokens_cjk(text: str) -> int:
+    """估算token数: 中日韩字符每个约1个token,其余字符约4个1个token"""
+    cjk = sum(1 for char in text if "\u2e80" <= char <= "\u9fff" or "\uac00" <= char <= "\ud7af" or "\uf900" <= char <= "\ufaff")
+    return cjk + (len(text) - cjk + 3) // 4
+
+def estimate_tokens_chars(text: str) -> int:
+    """估算token数: 每4个字符约1个token"""
+    return (len(text) + 3) // 4
+
+# 可选的本地token估算器,键为配置项token_estimator的取值
+TOKEN_ESTIMATORS: dict[str, Callable[[str], int]] = {
+    "cjk": estimate_tokens_cjk,
+    "chars": estimate_tokens_chars,
+}
+
+class StageHistogram:
+    """固定桶的耗时直方图"""
+    __slots__ = ("buckets", "count", "total")
+    BOUNDS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)             # 最后一个桶为+Inf
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, seconds: float):
+        self.buckets[bisect.bisect_left(self.BOUNDS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+    def quantile(self, q: float) -> float:
+        """按桶上界估算分位数"""
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, bucket in zip(self.BOUNDS, self.buckets):
+            seen += bucket
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+class _StageTimer:
+    __slots__ = ("metrics", "stage", "session_id", "start")
+
+    def __init__(self, metrics: "PluginMetrics", stage: str, session_id: str | None):
+        self.metrics = metrics
+        self.stage = stage
+        self.session_id = session_id
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.stage, time.perf_counter() - self.start, self.session_id)
+        if exc_type is not None and not issubclass(exc_type, asyncio.CancelledError):
+            self.metrics.inc(f"{self.stage}_errors", self.session_id)
+
+class PluginMetrics:
+    """各阶段的耗时直方图与计数器,汇总统计加上最近活跃会话的单独统计"""
+    def __init__(self, max_sessions: int = 1000):
+        self.max_sessions = max_sessions                        # 单独统计的会话数上限,按最近活跃淘汰
+        self.histograms: dict[str, StageHistogram] = {}
+        self.counters: dict[str, int] = {}
+        self.sessions: OrderedDict[str, dict[str, float]] = OrderedDict()   # {session_id: {计数名或阶段耗时: 值}}
+        self.started_at = time.time()
+
+    def _session(self, session_id: str) -> dict[str, float]:
+        stats = self.sessions.get(session_id)
+        if stats is None:
+            stats = self.sessions[session_id] = {}
+            while len(self.sessions) > self.max_sessions:
+                self.sessions.popitem(last=False)
+        else:
+            self.sessions.move_to_end(session_id)
+        return stats
+
+    def timer(self, stage: str, session_id: str | None = None) -> _StageTimer:
+        return _StageTimer(self, stage, session_id)
+
+    def observe(self, stage: str, seconds: float, session_id: str | None = None):
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = StageHistogram()
+        histogram.observe(seconds)
+        if session_id is not None and self.max_sessions > 0:
+            stats = self._session(session_id)
+            stats[f"{stage}_count"] = stats.get(f"{stage}_count", 0) + 1
+            stats[f"{stage}_seconds"] = stats.get(f"{stage}_seconds", 0.0) + seconds
+
+    def inc(self, name: str, session_id: str | None = None, value: int = 1):
+        self.counters[name] = self.counters.get(name, 0) + value
+        if session_id is not None and self.max_sessions > 0:
+            stats = self._session(session_id)
+            stats[name] = stats.get(name, 0) + value
+
+    def render_text(self, gauges: dict[str, float] | None = None) -> str:
+        lines = [f"统计开始于{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started_at))}", "阶段耗时:"]
+        for stage, histogram in sorted(self.histograms.items()):
+            avg = histogram.total / histogram.count * 1000 if histogram.count else 0
+            lines.append(
+                f"  {stage}: {histogram.count}次, 平均{avg:.1f}ms, "
+                f"p50≤{histogram.quantile(0.5) * 1000:g}ms, p99≤{histogram.quantile(0.99) * 1000:g}ms"
+            )
+        lines.append("计数:")
+        lines.extend(f"  {name}: {value}" for name, value in sorted(self.counters.items()))
+        if gauges:
+            lines.append("状态:")
+            lines.extend(f"  {name}: {value:g}" for name, value in gauges.items())
+        return "\n".join(lines)
+
+    def render_session(self, session_id: str) -> str:
+        stats = self.sessions.get(session_id)
+        if not stats:
+            return f"会话{session_id}没有统计数据"
+        lines = [f"会话{session_id}:"]
+        for name, value in sorted(stats.items()):
+            if name.endswith("_seconds"):
+                lines.append(f"  {name.removesuffix('_seconds')}_ms: {value * 1000:.1f}")
+            else:
+                lines.append(f"  {name}: {value:g}")
+        return "\n".join(lines)
+
+    def render_prometheus(self, gauges: dict[str, float] | None = None) -> str:
+        """Prometheus文本格式,只包含汇总统计"""
+        lines = []
+        if self.histograms:
+            lines.append("# TYPE memorychain_stage_seconds histogram")
+        for stage, histogram in sorted(self.histograms.items()):
+            cumulative = 0
+            for bound, bucket in zip(StageHistogram.BOUNDS, histogram.buckets):
+                cumulative += bucket
+                lines.append(f'memorychain_stage_seconds_bucket{{stage="{stage}",le="{bound}"}} {cumulative}')
+            lines.append(f'memorychain_stage_seconds_bucket{{stage="{stage}",le="+Inf"}} {histogram.count}')
+            lines.append(f'memorychain_stage_seconds_sum{{stage="{stage}"}} {histogram.total}')
+            lines.append(f'memorychain_stage_seconds_count{{stage="{stage}"}} {histogram.count}')
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"# TYPE memorychain_{name}_total counter")
+            lines.append(f"memorychain_{name}_total {value}")
+        for name, value in (gauges or {}).items():
+            lines.append(f"# TYPE memorychain_{name} gauge")
+            lines.append(f"memorychain_{name} {value}")
+        return "\n".join(lines) + "\n"
+
+def char_shingles(text: str, size: int = 3) -> set[str]:
+    """文本的字符n-gram集合,用于估计两段文本的重合度"""
+    text = "".join(text.split())
+    if len(text) <= size:
+        return {text} if text else set()
+    return {text[i:i + size] for i in range(len(text) - size + 1)}
+
+def jaccard(a: set[str], b: set[str]) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+def simhash64(text: str) -> int:
+    """基于字符三元组的64位SimHash,相似文本的指纹汉明距离小"""
+    weights = [0] * 64
+    for shingle in char_shingles(text):
+        value = int.from_bytes(hashlib.blake2b(shingle.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += 1 if value >> bit & 1 else -1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+def merge_summaries(old_text: str, new_text: str) -> str | None:
+    """把新摘要中旧摘要没有的句子追加到旧摘要后,没有新内容时返回None"""
+    old_sentences = {sentence.strip() for sentence in re.split(r"[。！？!?\n]", old_text) if sentence.strip()}
+    additions = [
+        sentence.strip() for sentence in re.split(r"(?<=[。！？!?\n])", new_text)
+        if sentence.strip() and sentence.strip().rstrip("。！？!?") not in old_sentences
+    ]
+    if not additions:
+        return None
+    return old_text.rstrip() + "\n" + "".join(additions)
+
+class MemoryFingerprintIndex:
+    """每个记忆数据库最近上传记忆的SimHash指纹,持久化到数据目录"""
+    def __init__(self, path: str, max_distance: int = 6, recent: int = 64, enabled: bool = True, delay: float = 2):
+        self.path = path
+        self.max_distance = max_distance                        # 汉明距离不超过该值视为近似重复
+        self.recent = recent                                    # 每个数据库保留的指纹数
+        self.enabled = enabled
+        self.entries: dict[str, list[list]] = {}                # {kb_name: [[指纹, doc_id, 文档中的摘要数], ...]},新的在后
+        self.writer = DebouncedJsonWriter(path, snapshot = lambda: {"entries": {k: list(v) for k, v in self.entries.items()}}, delay = delay)
+
+    async def load(self):
+        try:
+            if os.path.exists(self.path):
+                async with aiofiles.open(self.path, 'r', encoding='utf-8') as f:
+                    content = await f.read()
+                if content.strip():
+                    self.entries = json.loads(content).get("entries", {})
+                    self.writer.mark_clean(self.writer.snapshot())
+        except (json.JSONDecodeError, OSError) as e:
+            logger.error(f"[memorychain] 加载记忆指纹失败: {e}")
+
+    def find(self, kb_name: str, fingerprint: int) -> list | None:
+        """查找近似重复的记忆,返回[指纹, doc_id, 摘要数]"""
+        if not self.enabled:
+            return None
+        for entry in reversed(self.entries.get(kb_name, [])):
+            if (entry[0] ^ fingerprint).bit_count() <= self.max_distance:
+                return entry
+        return None
+
+    def add(self, kb_name: str, fingerprint: int, doc_id: str, items: int):
+        entries = self.entries.setdefault(kb_name, [])
+        entries.append([fingerprint, doc_id, items])
+        del entries[:-self.recent]
+        self.writer.schedule()
+
+    def remove_doc(self, kb_name: str, doc_id: str):
+        entries = self.entries.get(kb_name)
+        if entries:
+            self.entries[kb_name] = [entry for entry in entries if entry[1] != doc_id]
+            self.writer.schedule()
+
+    def drop_kb(self, kb_name: str):
+        if self.entries.pop(kb_name, None) is not None:
+            self.writer.schedule()
+
+class RetrievalGate:
+    """检索前的本地过滤,跳过检索结果没有参考价值的消息"""
+    STOPWORDS = frozenset({
+        "ok", "okk", "okay", "yes", "no", "hi", "hello", "lol", "thx", "thanks", "收到", "好", "好的", "好滴", "行", "可以",
+        "嗯", "嗯嗯", "哦", "哦哦", "噢", "啊", "哈", "哈哈", "哈哈哈", "呵呵", "嘿嘿", "6", "66", "666", "草", "谢谢", "早", "早安", "晚安",
+        "在吗", "在", "是", "是的", "对", "对的", "没事", "牛", "强", "?", "？",
+    })
+    COMMAND_PREFIXES = ("/", "!", "！", "#")
+
+    def __init__(
+            self,
+            min_length: int = 2,
+            cooldown: float = 0,
+            reuse_threshold: float = 0.9,
+            extra_stopwords: str = "",
+            max_sessions: int = 2000
+    ):
+        self.min_length = min_length                            # 有效字符(字母、数字、汉字)少于该值不检索
+        self.cooldown = cooldown                                # 同一会话两次检索的最小间隔(秒),期间复用上次结果,0为关闭
+        self.reuse_threshold = reuse_threshold                  # 与上一条检索消息的重合度达到该值时复用上次结果,0为关闭
+        self.stopwords = self.STOPWORDS | {word.strip().lower() for word in extra_stopwords.split(",") if word.strip()}
+        self.max_sessions = max_sessions
+        self.last: OrderedDict[str, tuple[float, set[str], list[dict]]] = OrderedDict()   # {会话或会话:发言人: (检索时间, 消息shingle, 检索结果)}
+
+    @staticmethod
+    def _content(message: str) -> str:
+        """去掉标点、空白与表情后的有效内容"""
+        return "".join(char for char in message if char.isalnum()).lower()
+
+    def check(self, session_id: str, message: str) -> tuple[str, list[dict] | None]:
+        """返回(判定, 可复用的检索结果),判定为pass时需要检索"""
+        if message.startswith(self.COMMAND_PREFIXES):
+            return "command", None
+        content = self._content(message)
+        if not content:
+            return "no_content", None
+        if content in self.stopwords or message.strip().lower() in self.stopwords:
+            return "stopword", None
+        if len(content) < self.min_length:
+            return "too_short", None
+        if len(set(content)) == 1:
+            # 哈哈哈哈、666666之类的重复字符
+            return "stopword", None
+        last = self.last.get(session_id)
+        if last is not None:
+            searched_at, shingles, results = last
+            if self.cooldown > 0 and time.monotonic() - searched_at < self.cooldown:
+                return "cooldown", results
+            if self.reuse_threshold > 0 and jaccard(char_shingles(content), shingles) >= self.reuse_threshold:
+                return "similar", results
+        return "pass", None
+
+    def remember(self, session_id: str, message: str, results: list[dict]):
+        """记录本次检索,供冷却与相似消息复用"""
+        self.last[session_id] = (time.monotonic(), char_shingles(self._content(message)), results)
+        self.last.move_to_end(session_id)
+        while len(self.last) > self.max_sessions > 0:
+            self.last.popitem(last=False)
+
+class ContextSelector:
+    """从检索结果中挑选注入系统提示词的记忆"""
+    def __init__(
+            self,
+            top_k: int = 5,
+            min_score: float = 0,
+            dedup_threshold: float = 0.8,
+            token_budget: int = 800,
+            estimator: Callable[[str], int] = estimate_tokens_cjk
+    ):
+        self.top_k = max(1, top_k)                              # 最多注入的条数
+        self.min_score = min_score                              # 最低相关度
+        self.dedup_threshold = dedup_threshold                  # 与已选记忆重合度达到该值视为重复,0为不去重
+        self.token_budget = token_budget                        # 注入内容的token上限,0为不限制
+        self.estimator = estimator
+
+    def select(self, results: list[dict]) -> tuple[list[str], int]:
+        """按分数从高到低挑选,返回(格式化后的记忆列表, 估算token数)"""
+        selected: list[str] = []
+        selected_shingles: list[set[str]] = []
+        used_tokens = 0
+        for result in sorted(results, key=lambda r: r.get("score", 0), reverse=True):
+            if len(selected) >= self.top_k:
+                break
+            if result.get("score", 0) < self.min_score:
+                break
+            content = result.get("content", "")
+            if self.dedup_threshold > 0:
+                shingles = char_shingles(content)
+                if any(jaccard(shingles, other) >= self.dedup_threshold for other in selected_shingles):
+                    continue
+            memory = f"{result.get('doc_name', '')}:\n{content}"
+            tokens = self.estimator(memory)
+            if self.token_budget > 0 and used_tokens + tokens > self.token_budget:
+                continue
+            selected.append(memory)
+            if self.dedup_threshold > 0:
+                selected_shingles.append(shingles)
+            used_tokens += tokens
+        return selected, used_tokens
+
 class CompressedChat:
-    """聊天记录类"""
-    recent_messages: list[str] = field(default_factory=list)    # 最近几条消息
-    message_count: int = 0                                      # 总消息数
+    """聊天记录类,使用定长环形缓冲区保存最近消息"""
+    __slots__ = ("recent_messages", "message_count", "kb_name", "last_active", "last_seq", "token_count", "summary")
+
+    def __init__(self, max_messages: int = 60, kb_name: str = ""):
+        self.recent_messages: deque[str] = deque(maxlen=max_messages)  # 最近几条消息
+        self.message_count: int = 0                                     # 总消息数
+        self.kb_name: str = kb_name                                     # 会话对应的记忆数据库
+        self.last_active: float = time.monotonic()                      # 最后活跃时间
+        self.last_seq: int = 0                                          # 最后一条消息在日志中的序号
+        self.token_count: int = 0                                       # 缓冲区消息的估算token数
+        self.summary: str = ""                                          # 滚动模式下上一次的摘要
 
-    def add_message(self, role: str, content: str, max_messages: int = 60):
-        """添加新消息"""
-        self.recent_messages.append(f"{role}: {content}")
+    def add_message(self, role: str, content: str, estimator: Callable[[str], int] = estimate_tokens_cjk):
+        """添加新消息,超出长度时自动丢弃最旧的消息"""
+        if len(self.recent_messages) == self.recent_messages.maxlen:
+            self.token_count -= estimator(self.recent_messages[0])
+        line = f"{role}: {content}"
+        self.recent_messages.append(line)
+        self.token_count += estimator(line)
         self.message_count += 1
-        # 保持最近消息数量限制
-        if len(self.recent_messages) > max_messages:
-            self.recent_messages.pop(0)
+        self.last_active = time.monotonic()
+
+    @staticmethod
+    def build_prompt(messages: list[str], previous_summary: str = "") -> str:
+        """根据消息列表构造压缩提示词,提供上一次摘要时只发送新增消息并要求更新摘要"""
+        if previous_summary:
+            return f"""Here is the existing summary of the conversation so far:\n\n{previous_summary}\n\nUpdate the summary with the following new messages, keep important earlier facts, time information should be include:\n\n{chr(10).join(messages)}\n\nUPDATED CONCISE SUMMARY IN CHINESE LESS THAN 300 TOKENS:"""
+        return f"""Write a concise summary of the following, time information should be include:\n\n{chr(10).join(messages)}\n\nCONCISE SUMMARY IN CHINESE LESS THAN 300 TOKENS:"""
 
     def get_context_text(self) -> str:
         """获取用于压缩上下文的文本"""
-        return f"""Write a concise summary of the following, time information should be include:\n\n{chr(10).join(self.recent_messages)}\n\nCONCISE SUMMARY IN CHINESE LESS THAN 300 TOKENS:"""
+        return self.build_prompt(list(self.recent_messages), self.summary)
 
     def clear_message(self):
         """清理所有聊天记录"""
-        self.recent_messages = []
+        self.recent_messages.clear()
         self.message_count = 0
+        self.token_count = 0
+
+    def memory_usage(self) -> int:
+        """估算占用的字节数"""
+        return (
+            sys.getsizeof(self)
+            + sys.getsizeof(self.recent_messages)
+            + sum(sys.getsizeof(message) for message in self.recent_messages)
+            + sys.getsizeof(self.summary)
+        )
 
 class SimpleChatCompressor:
-    """聊天记录压缩器"""
-    def __init__(self, max_history: int = 60, compress_threshold: int = 50):
+    """聊天记录压缩器,按最近活跃时间淘汰会话"""
+    def __init__(
+            self,
+            max_history: int = 60,
+            compress_threshold: int = 50,
+            max_sessions: int = 2000,
+            idle_timeout: float = 3600,
+            on_evict: Callable[[str, CompressedChat], Awaitable[None]] | None = None,
+            token_budget: int = 0,
+            estimator: Callable[[str], int] = estimate_tokens_cjk,
+            rolling: bool = False
+    ):
         self.max_history = max_history                          # 最大保留消息数
         self.compress_threshold = compress_threshold            # 压缩阈值
-        self.compressed_chats: dict[str, CompressedChat] = {}   # {session_id: CompressedChat}
+        self.token_budget = token_budget                        # 按估算token数触发压缩,0为按消息数触发
+        self.estimator = estimator                              # 本地token估算器
+        self.rolling = rolling                                  # 滚动摘要: 携带上一次摘要,只发送新增消息
+        self.max_sessions = max_sessions                        # 最大同时保留的会话数
+        self.idle_timeout = idle_timeout                        # 会话空闲多久后淘汰,0为不按时间淘汰
+        self.on_evict = on_evict                                # 会话被淘汰时的回调
+        self.compressed_chats: OrderedDict[str, CompressedChat] = OrderedDict()   # {session_id: CompressedChat},按活跃时间排序
+        self.evicted = 0
+        self.compressions = 0                                   # 压缩次数
+        self.prompt_tokens = 0                                  # 压缩发送的估算token总数
 
-    async def add_message(self, session_id: str, role: str, content: str, llm_fun: Callable | None, is_user: bool = False) -> str:
+    def _get_chat(self, session_id: str, kb_name: str) -> CompressedChat:
+        chat = self.compressed_chats.get(session_id)
+        if chat is None:
+            chat = CompressedChat(self.max_history, kb_name)
+            self.compressed_chats[session_id] = chat
+        else:
+            self.compressed_chats.move_to_end(session_id)
+            if kb_name:
+                chat.kb_name = kb_name
+        return chat
+
+    async def add_message(self, session_id: str, role: str, content: str, kb_name: str = "") -> CompressedChat:
         """添加消息到会话"""
-        if session_id not in self.compressed_chats:
-            self.compressed_chats[session_id] = CompressedChat()
+        chat = self._get_chat(session_id, kb_name)
+        chat.add_message(role, content, self.estimator)
+        # 超出会话上限时淘汰最久未活跃的会话
+        while len(self.compressed_chats) > self.max_sessions > 0:
+            await self._evict(next(iter(self.compressed_chats)))
+        return chat
+
+    async def _evict(self, session_id: str):
+        chat = self.compressed_chats.pop(session_id)
+        self.evicted += 1
+        if self.on_evict is not None and chat.recent_messages:
+            await self.on_evict(session_id, chat)
+
+    async def evict_idle(self):
+        """淘汰空闲超时的会话"""
+        if self.idle_timeout <= 0:
+            return
+        deadline = time.monotonic() - self.idle_timeout
+        while self.compressed_chats:
+            session_id, chat = next(iter(self.compressed_chats.items()))
+            if chat.last_active > deadline:
+                break
+            await self._evict(session_id)
+
+    def need_compress(self, session_id: str) -> bool:
+        """检查会话是否到达压缩阈值,按token预算触发时缓冲区写满也会触发,避免消息被挤出"""
+        chat = self.compressed_chats.get(session_id)
+        if chat is None:
+            return False
+        if self.token_budget > 0:
+            return chat.token_count >= self.token_budget or len(chat.recent_messages) >= self.max_history
+        return chat.message_count >= self.compress_threshold
+
+    def build_prompt(self, messages: list[str], previous_summary: str = "") -> str:
+        """构造压缩提示词并记录发送的token数"""
+        prompt = CompressedChat.build_prompt(messages, previous_summary if self.rolling else "")
+        tokens = self.estimator(prompt)
+        self.compressions += 1
+        self.prompt_tokens += tokens
+        logger.debug(f"[memorychain] 压缩{len(messages)}条消息,发送约{tokens}个token")
+        return prompt
+
+    def set_summary(self, session_id: str, summary: str) -> bool:
+        """滚动模式下记录会话的最新摘要,会话已被淘汰时返回False"""
+        chat = self.compressed_chats.get(session_id)
+        if not self.rolling or chat is None:
+            return False
+        chat.summary = summary
+        return True
+
+    def take_snapshot(self, session_id: str) -> list[str]:
+        """取出会话缓冲区的快照并清空,交给后台任务压缩"""
         chat = self.compressed_chats[session_id]
-        chat.add_message(role, content, self.max_history)
-        # 检查是否需要压缩,确保在AI回复时才进行压缩
-        if (not is_user) and (chat.message_count >= self.compress_threshold):
-            if llm_fun is None:
-                raise ValueError("llm_fun没有被设置")
-            summary = await llm_fun(chat.get_context_text())
-            # chat.clear_message()
-            return summary
-        return ""
+        messages = list(chat.recent_messages)
+        chat.clear_message()
+        return messages
+
+    def restore(self, session_id: str, messages: list[str], last_seq: int = 0) -> bool:
+        """把未能压缩的快照放回缓冲区头部,超出max_history的旧消息被丢弃;会话已被淘汰时不重新创建,返回False"""
+        chat = self.compressed_chats.get(session_id)
+        if chat is None:
+            return False
+        self._prepend(chat, messages, last_seq)
+        return True
+
+    def _prepend(self, chat: CompressedChat, messages: list[str], last_seq: int):
+        current = list(chat.recent_messages)
+        chat.recent_messages.clear()
+        chat.recent_messages.extend(messages + current)
+        chat.message_count += len(messages)
+        chat.token_count = sum(self.estimator(message) for message in chat.recent_messages)
+        chat.last_seq = max(chat.last_seq, last_seq)
+
+    def load_session(self, session_id: str, kb_name: str, messages: list[str], last_seq: int, summary: str = ""):
+        """从日志回放会话缓冲区"""
+        self._prepend(self._get_chat(session_id, kb_name), messages, last_seq)
+        if summary:
+            self.set_summary(session_id, summary)
+
+    def reload_session(self, session_id: str, kb_name: str, messages: list[str], last_seq: int, summary: str = ""):
+        """用日志中的完整记录替换会话缓冲区,内存中的消息都已写入日志"""
+        self.compressed_chats.pop(session_id, None)
+        self.load_session(session_id, kb_name, messages, last_seq, summary)
+
+    def memory_usage(self) -> int:
+        """估算所有会话缓冲区占用的字节数"""
+        return sys.getsizeof(self.compressed_chats) + sum(
+            sys.getsizeof(session_id) + chat.memory_usage()
+            for session_id, chat in self.compressed_chats.items()
+        )
 
     async def del_message(self, session_id: str):
         chat = self.compressed_chats[session_id]
         chat.clear_message()
+
+class ChatJournal:
+    """未压缩聊天记录的追加日志(SQLite WAL),批量提交以减少fsync"""
+    def __init__(self, path: str, flush_interval: float = 1, batch_size: int = 200):
+        self.path = path
+        self.flush_interval = flush_interval                    # 批量提交间隔(秒)
+        self.batch_size = batch_size                            # 积压多少条时立即提交
+        self.conn: sqlite3.Connection | None = None
+        self.seq = 0                                            # 单调递增的消息序号
+        self.pending_rows: list[tuple[int, str, str, str]] = []
+        self.pending_truncates: dict[str, int] = {}
+        self.pending_summaries: dict[str, tuple[str, str] | None] = {}   # None表示删除
+        self.lock = asyncio.Lock()
+        self.flush_task: asyncio.Task | None = None
+        self.wakeup = asyncio.Event()                           # 积压达到batch_size时唤醒提交循环
+        self.closing = False
+        self.parked: set[str] = set()                           # 被淘汰但消息仍留在日志中的会话
+
+    def _open(self, max_sessions: int = 0) -> tuple[dict[str, tuple[str, list[str], int]], dict[str, tuple[str, str]]]:
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("CREATE TABLE IF NOT EXISTS messages (seq INTEGER PRIMARY KEY, session_id TEXT NOT NULL, kb_name TEXT NOT NULL, line TEXT NOT NULL)")
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_messages_session ON messages (session_id, seq)")
+        conn.execute("CREATE TABLE IF NOT EXISTS summaries (session_id TEXT PRIMARY KEY, kb_name TEXT NOT NULL, summary TEXT NOT NULL)")
+        conn.commit()
+        self.seq = conn.execute("SELECT COALESCE(MAX(seq), 0) FROM messages").fetchone()[0]
+        # 只回放最近活跃的max_sessions个会话,其余会话留在日志中,再次活跃时由load_session载入
+        recent = [
+            session_id for session_id, _ in
+            conn.execute("SELECT session_id, MAX(seq) AS last_seq FROM messages GROUP BY session_id ORDER BY last_seq DESC")
+        ]
+        if max_sessions > 0:
+            self.parked.update(recent[max_sessions:])
+            recent = recent[:max_sessions]
+        sessions: dict[str, tuple[str, list[str], int]] = {}
+        for session_id in reversed(recent):
+            rows = conn.execute("SELECT seq, kb_name, line FROM messages WHERE session_id = ? ORDER BY seq", (session_id,)).fetchall()
+            sessions[session_id] = (rows[-1][1], [line for _, _, line in rows], rows[-1][0])
+        summaries = {
+            session_id: (kb_name, summary)
+            for session_id, kb_name, summary in conn.execute("SELECT session_id, kb_name, summary FROM summaries")
+        }
+        self.conn = conn
+        return sessions, summaries
+
+    async def open(self, max_sessions: int = 0) -> tuple[dict[str, tuple[str, list[str], int]], dict[str, tuple[str, str]]]:
+        """打开日志,返回需要回放的会话 {session_id: (kb_name, 消息列表, 最后序号)} 与滚动摘要 {session_id: (kb_name, 摘要)}
+
+        max_sessions大于0时只返回最近活跃的会话,其余会话记入parked
+        """
+        result = await asyncio.to_thread(self._open, max_sessions)
+        self.flush_task = asyncio.create_task(self._flush_loop())
+        return result
+
+    def append(self, session_id: str, kb_name: str, line: str) -> int:
+        """追加一条消息,只写入内存队列,由后台批量提交"""
+        self.seq += 1
+        self.pending_rows.append((self.seq, session_id, kb_name, line))
+        if len(self.pending_rows) >= self.batch_size:
+            self.wakeup.set()
+        return self.seq
+
+    def truncate(self, session_id: str, seq: int):
+        """删除会话中序号不大于seq的消息(已经压缩上传)"""
+        self.pending_truncates[session_id] = max(seq, self.pending_truncates.get(session_id, 0))
+        self.pending_rows = [
+            row for row in self.pending_rows
+            if not (row[1] == session_id and row[0] <= seq)
+        ]
+
+    def set_summary(self, session_id: str, kb_name: str, summary: str):
+        """记录会话的滚动摘要"""
+        self.pending_summaries[session_id] = (kb_name, summary)
+
+    def forget_summary(self, session_id: str):
+        """删除会话的滚动摘要"""
+        self.pending_summaries[session_id] = None
+
+    def park(self, session_id: str):
+        """会话被淘汰但保留日志中的消息,再次活跃时由load_session载入"""
+        self.parked.add(session_id)
+
+    def _read_session(self, session_id: str) -> tuple[list[tuple[int, str]], str]:
+        rows = self.conn.execute("SELECT seq, line FROM messages WHERE session_id = ? ORDER BY seq", (session_id,)).fetchall()
+        row = self.conn.execute("SELECT summary FROM summaries WHERE session_id = ?", (session_id,)).fetchone()
+        return rows, row[0] if row else ""
+
+    async def load_session(self, session_id: str) -> tuple[list[str], int, str] | None:
+        """读取会话留在日志中的消息,返回(消息列表, 最后序号, 滚动摘要),日志已关闭时返回None"""
+        await self.flush()
+        async with self.lock:
+            if self.conn is None:
+                return None
+            rows, summary = await asyncio.to_thread(self._read_session, session_id)
+        # 提交失败或读取期间新追加的消息还在内存队列中
+        rows += [(seq, line) for seq, row_session, _, line in self.pending_rows if row_session == session_id]
+        truncated = self.pending_truncates.get(session_id, 0)
+        rows = [(seq, line) for seq, line in rows if seq > truncated]
+        if session_id in self.pending_summaries:
+            pending = self.pending_summaries[session_id]
+            summary = pending[1] if pending is not None else ""
+        return [line for _, line in rows], rows[-1][0] if rows else 0, summary
+
+    def _write(self, rows: list[tuple[int, str, str, str]], truncates: dict[str, int], summaries: dict[str, tuple[str, str] | None]):
+        with self.conn:
+            if rows:
+                self.conn.executemany("INSERT INTO messages (seq, session_id, kb_name, line) VALUES (?, ?, ?, ?)", rows)
+            if truncates:
+                self.conn.executemany("DELETE FROM messages WHERE session_id = ? AND seq <= ?", truncates.items())
+            for session_id, value in summaries.items():
+                if value is None:
+                    self.conn.execute("DELETE FROM summaries WHERE session_id = ?", (session_id,))
+                else:
+                    self.conn.execute("INSERT OR REPLACE INTO summaries (session_id, kb_name, summary) VALUES (?, ?, ?)", (session_id, *value))
+
+    async def flush(self):
+        """把积压的写入与截断在一个事务中提交"""
+        async with self.lock:
+            if self.conn is None or not (self.pending_rows or self.pending_truncates or self.pending_summaries):
+                return
+            rows, self.pending_rows = self.pending_rows, []
+            truncates, self.pending_truncates = self.pending_truncates, {}
+            summaries, self.pending_summaries = self.pending_summaries, {}
+            try:
+                await asyncio.to_thread(self._write, rows, truncates, summaries)
+            except Exception as e:
+                # 写入失败时放回队列,下次重试
+                self.pending_rows = rows + self.pending_rows
+                for session_id, seq in truncates.items():
+                    self.pending_truncates[session_id] = max(seq, self.pending_truncates.get(session_id, 0))
+                self.pending_summaries = {**summaries, **self.pending_summaries}
+                logger.error(f"[memorychain] 写入聊天日志失败: {e}")
+
+    async def _flush_loop(self):
+        while not self.closing:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+    async def close(self):
+        # 不取消提交循环: 取消会在线程中的写入完成前释放锁,随后的写入与关闭会并发使用同一个连接
+        self.closing = True
+        if self.flush_task is not None:
+            self.wakeup.set()
+            await self.flush_task
+            self.flush_task = None
+        await self.flush()
+        if self.conn is not None:
+            conn, self.conn = self.conn, None
+            await asyncio.to_thread(conn.close)
+
+def write_text_atomic(path: str, content: str):
+    """写临时文件后原子替换"""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(content)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+class DebouncedJsonWriter:
+    """JSON持久化: 合并短时间内的多次保存,内容未变化时跳过,写临时文件后原子替换"""
+    def __init__(self, path: str, snapshot: Callable[[], dict], delay: float = 2, observer: Callable[[float], None] | None = None):
+        self.path = path
+        self.snapshot = snapshot                                # 返回需要保存的数据
+        self.delay = delay                                      # 合并写入的等待秒数
+        self.observer = observer                                # 每次实际写入后回调写入耗时(秒)
+        self.task: asyncio.Task | None = None
+        self.sleeping = False                                   # 延迟任务是否还在等待,只有等待中的任务可以取消
+        self.dirty = False                                      # 有尚未写入的修改
+        self.lock = asyncio.Lock()
+        self.last_digest: bytes | None = None                   # 上次写入内容的摘要
+        self.writes = 0
+        self.skipped = 0
+
+    @staticmethod
+    def _digest(data: dict) -> bytes:
+        content = json.dumps(data, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+        return hashlib.blake2b(content.encode("utf-8"), digest_size=16).digest()
+
+    def mark_clean(self, data: dict):
+        """标记当前数据与磁盘一致,例如刚从文件加载"""
+        self.last_digest = self._digest(data)
+
+    def schedule(self):
+        """请求保存,delay秒内的多次请求只写入一次"""
+        self.dirty = True
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        # 写入期间又有修改时再等待一轮,修改不会停留在内存中
+        while self.dirty:
+            self.sleeping = True
+            try:
+                await asyncio.sleep(self.delay)
+            finally:
+                self.sleeping = False
+            await self.flush()
+
+    def _write(self, data: dict) -> bool:
+        digest = self._digest(data)
+        if digest == self.last_digest:
+            return False
+        content = json.dumps({**data, "last_updated": time.time()}, ensure_ascii=False, separators=(",", ":"))
+        write_text_atomic(self.path, content)
+        self.last_digest = digest
+        return True
+
+    async def flush(self):
+        """立即写入尚未保存的修改"""
+        # 正在写入的任务不能取消,否则线程仍在写临时文件,会与这次写入交错;等待锁即可
+        if self.task is not None and self.sleeping and self.task is not asyncio.current_task():
+            self.task.cancel()
+        async with self.lock:
+            self.dirty = False
+            try:
+                start = time.perf_counter()
+                # 序列化与写入放到线程中,避免大数据量时阻塞事件循环
+                if await asyncio.to_thread(self._write, self.snapshot()):
+                    self.writes += 1
+                    if self.observer is not None:
+                        self.observer(time.perf_counter() - start)
+                    logger.debug("[memorychain] 持久化数据保存成功")
+                else:
+                    self.skipped += 1
+            except OSError as e:
+                self.dirty = True
+                logger.error(f"[memorychain] 保存持久化数据失败: {e}")
+            except Exception as e:
+                self.dirty = True
+                logger.error(f"[memorychain] 保存数据时发生未知错误: {e}")
+
+class KBHandleCache:
+    """记忆数据库句柄缓存,kb_name -> KBHelper,不存在的数据库做短期负缓存,超过上限按最久未用淘汰"""
+    def __init__(self, context: Context, negative_ttl: float = 30, max_size: int = 2000):
+        self.context = context
+        self.negative_ttl = negative_ttl                        # 负缓存有效期,过期后重新查找,以发现在面板中新建的数据库
+        self.max_size = max_size                                # 最大缓存条数,0为不限制
+        self.entries: OrderedDict[str, tuple[KBHelper | None, float]] = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    async def get(self, kb_name: str) -> KBHelper | None:
+        entry = self.entries.get(kb_name)
+        if entry is not None:
+            kb_helper, expires_at = entry
+            if kb_helper is not None:
+                # 数据库可能在面板中被删除或重载,校验句柄仍然有效
+                if self.context.kb_manager.kb_insts.get(kb_helper.kb.kb_id) is kb_helper:
+                    self.entries.move_to_end(kb_name)
+                    self.hits += 1
+                    return kb_helper
+            elif expires_at > time.monotonic():
+                self.entries.move_to_end(kb_name)
+                self.hits += 1
+                return None
+        self.misses += 1
+        kb_helper = await self.context.kb_manager.get_kb_by_name(kb_name)
+        self.set(kb_name, kb_helper)
+        return kb_helper
+
+    def peek(self, kb_name: str) -> KBHelper | None:
+        """只读缓存,不查找数据库,也不计入命中统计与LRU顺序"""
+        entry = self.entries.get(kb_name)
+        if entry is None or entry[0] is None:
+            return None
+        kb_helper = entry[0]
+        return kb_helper if self.context.kb_manager.kb_insts.get(kb_helper.kb.kb_id) is kb_helper else None
+
+    def set(self, kb_name: str, kb_helper: KBHelper | None):
+        self.entries[kb_name] = (kb_helper, time.monotonic() + self.negative_ttl)
+        self.entries.move_to_end(kb_name)
+        if len(self.entries) > self.max_size > 0:
+            # 先清掉过期的负缓存,仍超出上限时再淘汰最久未用的条目
+            now = time.monotonic()
+            for name in [name for name, (helper, expires_at) in self.entries.items() if helper is None and expires_at <= now]:
+                del self.entries[name]
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+    def invalidate(self, kb_name: str):
+        self.entries.pop(kb_name, None)
+
+    def clear(self):
+        self.entries.clear()
+
+class RetrievalCache:
+    """检索结果LRU缓存,键为(kb_name, 归一化后的query)"""
+    def __init__(self, max_size: int = 256, ttl: float = 60, max_generations: int = 2000):
+        self.max_size = max_size                                # 最大缓存条数,0为关闭
+        self.ttl = ttl                                          # 过期秒数
+        self.max_generations = max_generations                  # 最多记录写入代数的数据库个数,0为不限制
+        self.entries: OrderedDict[tuple[str, str], tuple[float, dict]] = OrderedDict()
+        self.generations: OrderedDict[str, int] = OrderedDict() # 每个数据库的写入代数,防止检索过程中写入的旧结果回填
+        self.epoch = 0                                          # 全部清空的次数
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def normalize(query: str) -> str:
+        return " ".join(query.split()).lower()
+
+    def generation(self, kb_name: str) -> tuple[int, int]:
+        return self.epoch, self.generations.get(kb_name, 0)
+
+    def get(self, kb_name: str, query: str) -> dict | None:
+        key = (kb_name, self.normalize(query))
+        entry = self.entries.get(key)
+        if entry is None or entry[0] < time.monotonic():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, kb_name: str, query: str, results: dict, generation: tuple[int, int] | None = None):
+        """写入缓存,generation与当前不一致说明检索期间数据库已被写入,放弃缓存"""
+        if self.max_size <= 0:
+            return
+        if generation is not None and generation != self.generation(kb_name):
+            return
+        key = (kb_name, self.normalize(query))
+        self.entries[key] = (time.monotonic() + self.ttl, results)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def invalidate(self, kb_name: str):
+        """清除某个数据库的所有缓存"""
+        self.generations[kb_name] = self.generations.get(kb_name, 0) + 1
+        self.generations.move_to_end(kb_name)
+        if len(self.generations) > self.max_generations > 0:
+            # 淘汰的数据库代数会归零,可能与检索开始时记下的代数相同,增加epoch让进行中的检索全部放弃回填
+            self.generations.popitem(last=False)
+            self.epoch += 1
+        for key in [key for key in self.entries if key[0] == kb_name]:
+            del self.entries[key]
+
+    def clear(self):
+        self.epoch += 1
+        self.entries.clear()
+
+class KeyedLocks:
+    """按数据库名称分配的互斥锁,超过上限时淘汰最久未用且没有协程持有或等待的锁"""
+    def __init__(self, max_size: int = 2000):
+        self.max_size = max_size                                # 最多保留的锁数,0为不限制
+        self.locks: OrderedDict[str, list] = OrderedDict()      # name -> [asyncio.Lock, 持有与等待的协程数]
+
+    @asynccontextmanager
+    async def hold(self, name: str):
+        entry = self.locks.get(name)
+        if entry is None:
+            entry = self.locks[name] = [asyncio.Lock(), 0]
+        self.locks.move_to_end(name)
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            self._prune()
+
+    def _prune(self):
+        excess = len(self.locks) - self.max_size
+        if self.max_size <= 0 or excess <= 0:
+            return
+        # 仍有协程持有或等待的锁不能淘汰,否则之后的调用会拿到新锁而失去互斥
+        for name in [name for name, (lock, users) in self.locks.items() if users == 0][:excess]:
+            del self.locks[name]
+
+@dataclass
+class CompressionJob:
+    """一次后台压缩任务"""
+    session_id: str                                             # 会话id
+    kb_name: str                                                # 目标记忆数据库
+    file_name: str                                              # 上传的文档名称
+    messages: list[str]                                         # 会话缓冲区快照
+    journal_seq: int = 0                                        # 快照中最后一条消息在日志中的序号
+    previous_summary: str = ""                                  # 滚动模式下上一次的摘要
+    created_at: float = field(default_factory=time.time)        # 入队时间
+
+class CompressionWorkerPool:
+    """后台压缩任务池,有界队列+固定数量的worker"""
+    def __init__(
+            self,
+            handler: Callable[[CompressionJob], Awaitable[None]],
+            workers: int = 2,
+            queue_size: int = 100,
+            policy: str = "drop_oldest",                        # 队列满时: drop_oldest丢弃最旧任务, block等待空位
+            on_fail: Callable[[CompressionJob, str], None] | None = None
+    ):
+        self.handler = handler
+        self.workers = max(1, workers)
+        self.queue_size = max(1, queue_size)
+        self.policy = policy
+        self.on_fail = on_fail
+        self.queue: asyncio.Queue | None = None
+        self.pending: set[str] = set()                          # 排队或执行中的会话,保证每个会话只有一个任务
+        self.tasks: list[asyncio.Task] = []
+        self.closed = False
+        self.completed = 0
+        self.failed = 0
+        self.dropped = 0
+
+    def start(self):
+        """启动worker,需要在事件循环中调用"""
+        if self.tasks:
+            return
+        self.closed = False
+        self.queue = asyncio.Queue(maxsize=self.queue_size)
+        self.tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def is_pending(self, session_id: str) -> bool:
+        return session_id in self.pending
+
+    def is_full(self) -> bool:
+        return self.queue is not None and self.queue.full()
+
+    async def submit(self, job: CompressionJob) -> bool:
+        """提交任务,会话已有任务或任务池已关闭时返回False"""
+        if self.closed or job.session_id in self.pending:
+            return False
+        if self.queue is None:
+            self.start()
+        if self.queue.full() and self.policy == "drop_oldest":
+            old_job: CompressionJob = self.queue.get_nowait()
+            self.queue.task_done()
+            self.pending.discard(old_job.session_id)
+            self.dropped += 1
+            if self.on_fail:
+                self.on_fail(old_job, "因队列已满被丢弃")
+        self.pending.add(job.session_id)
+        await self.queue.put(job)
+        return True
+
+    async def _worker(self):
+        while True:
+            job: CompressionJob = await self.queue.get()
+            try:
+                await self.handler(job)
+                self.completed += 1
+            except asyncio.CancelledError:
+                if self.on_fail:
+                    self.on_fail(job, "被取消")
+                raise
+            except Exception as e:
+                self.failed += 1
+                logger.error(f"[memorychain] 会话{job.session_id}压缩失败: {e}")
+                if self.on_fail:
+                    self.on_fail(job, "执行失败")
+            finally:
+                self.pending.discard(job.session_id)
+                self.queue.task_done()
+
+    async def drain(self, timeout: float = 30):
+        """停止接收新任务,等待队列中的任务完成后关闭worker"""
+        self.closed = True
+        if self.queue is not None:
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout)
+            except asyncio.TimeoutError:
+                logger.warning(f"[memorychain] 压缩任务池在{timeout}秒内未能清空,剩余{self.queue.qsize()}个任务")
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        self.tasks = []
+
+def doc_timestamp(doc: KBDocument) -> float:
+    """文档创建时间的时间戳,兼容datetime与数字"""
+    created_at = getattr(doc, "created_at", None)
+    if created_at is None:
+        return time.time()
+    if hasattr(created_at, "timestamp"):
+        return created_at.timestamp()
+    return float(created_at)
+
+async def list_kb_documents(kb_helper: KBHelper, page_size: int = 100) -> list[KBDocument]:
+    """分页列出数据库的所有文档"""
+    docs: list[KBDocument] = []
+    offset = 0
+    while True:
+        batch = await kb_helper.list_documents(offset = offset, limit = page_size)
+        docs.extend(batch)
+        if len(batch) < page_size:
+            break
+        offset += page_size
+    return docs
+
+async def read_document_chunks(kb_helper: KBHelper, doc_id: str, page_size: int = 100) -> list[str]:
+    """分页读取文档的所有文本块"""
+    texts: list[str] = []
+    offset = 0
+    while True:
+        chunks = await kb_helper.get_chunks_by_doc_id(doc_id, offset = offset, limit = page_size)
+        texts.extend(chunk.get("content", "") for chunk in chunks)
+        if len(chunks) < page_size:
+            break
+        offset += page_size
+    return [text for text in texts if text]
+
+class MemoryCompactor:
+    """记忆数据库的后台整理: 把旧文档按周/月合并为一份阶段摘要并删除原文档,执行保留期限与文档数上限
+
+    每个数据库依次处理,同时整理的数据库数有上限;每次调用LLM或删除文档前先让出时间,
+    压缩队列中有任务时等待,不与实时对话争抢LLM和嵌入
+    """
+    def __init__(
+            self,
+            summarize: Callable[[str], Awaitable[str]],
+            uploader: Callable[[KBHelper, str, list[str]], Awaitable[KBDocument]],
+            period: str = "week",                               # 合并的时间段: week或month
+            min_age_days: float = 7,                            # 只整理创建时间早于该天数的文档
+            min_docs: int = 3,                                  # 一个时间段至少有这么多文档才合并
+            retention_days: float = 0,                          # 删除早于该天数的文档,0为不删除
+            max_docs: int = 0,                                  # 每个数据库保留的最多文档数,0为不限制
+            concurrency: int = 1,                               # 同时整理的数据库数
+            throttle: float = 1,                                # 每次调用LLM或删除文档前的间隔(秒)
+            max_input_chars: int = 6000,                        # 单次合并送给LLM的最多字符数
+            is_busy: Callable[[], bool] | None = None,          # 返回True时暂停整理
+            on_removed: Callable[[str, str], None] | None = None,
+            lock_for: Callable[[str], asyncio.Lock] | None = None,  # 数据库的写锁,与实时压缩的上传共用
+            is_migrating: Callable[[str], bool] | None = None   # 返回True时停止整理该数据库
+    ):
+        self.summarize = summarize
+        self.uploader = uploader
+        self.period = period
+        self.min_age_days = min_age_days
+        self.min_docs = max(2, min_docs)
+        self.retention_days = retention_days
+        self.max_docs = max_docs
+        self.concurrency = max(1, concurrency)
+        self.throttle = throttle
+        self.max_input_chars = max(500, max_input_chars)
+        self.is_busy = is_busy
+        self.on_removed = on_removed
+        self.lock_for = lock_for or (lambda kb_name: asyncio.Lock())
+        self.is_migrating = is_migrating
+        self.running = False
+        self.merged = 0                                         # 被合并的文档数
+        self.created = 0                                        # 生成的阶段摘要数
+        self.deleted = 0                                        # 因保留期限或数量上限删除的文档数
+
+    def period_of(self, timestamp: float) -> str:
+        day = time.localtime(timestamp)
+        if self.period == "month":
+            return f"{day.tm_year}年{day.tm_mon:02d}月"
+        year, week, _ = datetime.date(day.tm_year, day.tm_mon, day.tm_mday).isocalendar()
+        return f"{year}年第{week:02d}周"
+
+    @staticmethod
+    def doc_time(doc: KBDocument) -> float:
+        """文档所属的时间: 阶段摘要取其时间段的开始,其余文档取创建时间"""
+        match = re.search(r"_(\d{4})年第(\d{2})周汇总$", doc.doc_name)
+        if match:
+            return time.mktime(datetime.date.fromisocalendar(int(match[1]), int(match[2]), 1).timetuple())
+        match = re.search(r"_(\d{4})年(\d{2})月汇总$", doc.doc_name)
+        if match:
+            return time.mktime(datetime.date(int(match[1]), int(match[2]), 1).timetuple())
+        return doc_timestamp(doc)
+
+    @staticmethod
+    def build_prompt(period: str, texts: list[str]) -> str:
+        return (
+            f"以下是{period}期间按时间顺序排列的多份对话记忆摘要,请合并为一份完整的阶段记忆。"
+            "保留人物、事件、偏好、约定等关键信息,去掉重复内容,只输出合并后的摘要:\n"
+            + "\n".join(texts)
+        )
+
+    async def _pause(self):
+        """让出时间给实时对话"""
+        await asyncio.sleep(self.throttle)
+        while self.is_busy is not None and self.is_busy():
+            await asyncio.sleep(max(self.throttle, 0.5))
+
+    async def _list_documents(self, kb_helper: KBHelper) -> list[KBDocument]:
+        docs = await list_kb_documents(kb_helper)
+        docs.sort(key = self.doc_time)
+        return docs
+
+    async def _merge_texts(self, period: str, texts: list[str]) -> str:
+        """合并一组摘要,超过单次输入上限时先分段合并"""
+        while True:
+            groups: list[list[str]] = [[]]
+            size = 0
+            for text in texts:
+                text = text[:self.max_input_chars]
+                if groups[-1] and size + len(text) > self.max_input_chars:
+                    groups.append([])
+                    size = 0
+                groups[-1].append(text)
+                size += len(text)
+            merged = []
+            for group in groups:
+                await self._pause()
+                summary = await self.summarize(self.build_prompt(period, group))
+                if not summary:
+                    raise ValueError(f"{period}的合并摘要为空")
+                merged.append(summary)
+            if len(merged) == 1:
+                return merged[0]
+            if len(merged) >= len(texts):
+                raise ValueError(f"{period}的合并摘要没有变短")
+            texts = merged
+
+    def _check_writable(self, kb_name: str):
+        if self.is_migrating is not None and self.is_migrating(kb_name):
+            raise RuntimeError(f"{kb_name}正在重新嵌入,停止整理")
+
+    async def _upload(self, kb_helper: KBHelper, file_name: str, texts: list[str]):
+        kb_name = kb_helper.kb.kb_name
+        async with self.lock_for(kb_name):
+            self._check_writable(kb_name)
+            await self.uploader(kb_helper, file_name, texts)
+
+    async def _delete(self, kb_helper: KBHelper, doc: KBDocument):
+        # 持有写锁并重新检查,整理开始后才进入重新嵌入的数据库不会再被写入
+        kb_name = kb_helper.kb.kb_name
+        async with self.lock_for(kb_name):
+            self._check_writable(kb_name)
+            await kb_helper.delete_document(doc.doc_id)
+        if self.on_removed is not None:
+            self.on_removed(kb_name, doc.doc_id)
+
+    async def compact(self, kb_helper: KBHelper) -> tuple[int, int, int]:
+        """整理一个数据库,返回(被合并的文档数, 生成的阶段摘要数, 删除的文档数)"""
+        kb_name = kb_helper.kb.kb_name
+        merged = created = deleted = 0
+        docs = await self._list_documents(kb_helper)
+        now = time.time()
+        # 保留期限
+        if self.retention_days > 0:
+            expired = [doc for doc in docs if self.doc_time(doc) < now - self.retention_days * 86400]
+            for doc in expired:
+                await self._pause()
+                await self._delete(kb_helper, doc)
+            deleted += len(expired)
+            docs = docs[len(expired):]
+        # 按时间段合并,当前时间段与较新的文档不动
+        if self.period in ("week", "month"):
+            current = self.period_of(now)
+            groups: dict[str, list[KBDocument]] = {}
+            for doc in docs:
+                timestamp = self.doc_time(doc)
+                period = self.period_of(timestamp)
+                if timestamp < now - self.min_age_days * 86400 and period != current:
+                    groups.setdefault(period, []).append(doc)
+            prefix = kb_name.replace("记忆链", "")
+            for period, group in groups.items():
+                if len(group) < self.min_docs:
+                    continue
+                self._check_writable(kb_name)
+                try:
+                    texts = ["\n".join(await read_document_chunks(kb_helper, doc.doc_id)) for doc in group]
+                    summary = await self._merge_texts(period, [text for text in texts if text])
+                    await self._pause()
+                    await self._upload(kb_helper, f"{prefix}_{period}汇总", [summary])
+                except Exception as e:
+                    logger.warning(f"[memorychain] 合并{kb_name}在{period}的{len(group)}个文档失败: {e}")
+                    continue
+                for doc in group:
+                    await self._pause()
+                    await self._delete(kb_helper, doc)
+                merged += len(group)
+                created += 1
+                logger.info(f"[memorychain] {kb_name}: 已将{period}的{len(group)}个文档合并为一份摘要")
+            if created:
+                docs = await self._list_documents(kb_helper)
+        # 文档数上限,删除最旧的文档
+        if self.max_docs > 0 and len(docs) > self.max_docs:
+            overflow = docs[:len(docs) - self.max_docs]
+            for doc in overflow:
+                await self._pause()
+                await self._delete(kb_helper, doc)
+            deleted += len(overflow)
+        self.merged += merged
+        self.created += created
+        self.deleted += deleted
+        return merged, created, deleted
+
+    async def run(self, kb_helpers: list[KBHelper]) -> tuple[int, int, int]:
+        """整理一组数据库,已有整理在进行时直接返回"""
+        if self.running:
+            return 0, 0, 0
+        self.running = True
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def compact_one(kb_helper: KBHelper) -> tuple[int, int, int]:
+            async with semaphore:
+                try:
+                    return await self.compact(kb_helper)
+                except Exception as e:
+                    logger.error(f"[memorychain] 整理{kb_helper.kb.kb_name}失败: {e}")
+                    return 0, 0, 0
+
+        try:
+            results = await asyncio.gather(*(compact_one(kb_helper) for kb_helper in kb_helpers))
+        finally:
+            self.running = False
+        return tuple(sum(values) for values in zip(*results)) if results else (0, 0, 0)
+
+class MigrationCheckpoint:
+    """迁移断点: 连续完成的序号水位与水位之后已完成的序号,每完成一项原子写入,中断后从水位继续"""
+    def __init__(self, path: str):
+        self.path = path
+        self.offset = 0                                         # 该序号之前的项全部完成
+        self.done: set[int] = set()                             # 水位之后已完成的序号,数量不超过并发数
+        self.extra: dict = {}                                   # 各迁移自己的状态,例如导出文件长度
+        self.lock = asyncio.Lock()
+
+    def load(self) -> bool:
+        """读取断点,返回是否存在"""
+        if not os.path.exists(self.path):
+            return False
+        try:
+            with open(self.path, encoding = "utf-8") as f:
+                data = json.load(f)
+        except (json.JSONDecodeError, OSError) as e:
+            logger.warning(f"[memorychain] 读取迁移断点{self.path}失败,从头开始: {e}")
+            return False
+        self.offset = data.get("offset", 0)
+        self.done = set(data.get("done", []))
+        self.extra = data.get("extra", {})
+        return True
+
+    def is_done(self, index: int) -> bool:
+        return index < self.offset or index in self.done
+
+    async def mark(self, index: int, **extra):
+        self.done.add(index)
+        while self.offset in self.done:
+            self.done.discard(self.offset)
+            self.offset += 1
+        self.extra.update(extra)
+        await self.save()
+
+    async def save(self):
+        async with self.lock:
+            content = json.dumps({"offset": self.offset, "done": sorted(self.done), "extra": self.extra}, ensure_ascii=False)
+            await asyncio.to_thread(write_text_atomic, self.path, content)
+
+    def remove(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+class MemoryMigrator:
+    """记忆数据库的导出、导入与重新嵌入
+
+    文档逐个流式读取与写入,内存占用与数据库大小无关;嵌入通过上传接口分批进行,
+    同时处理的文档数有上限;每完成一个文档记录断点,中断后再次执行同一操作会从断点继续
+    """
+    def __init__(
+            self,
+            uploader: Callable[[KBHelper, str, list[str]], Awaitable[KBDocument]],
+            work_dir: str,
+            concurrency: int = 2
+    ):
+        self.uploader = uploader                                # 上传一组文本块,返回文档
+        self.work_dir = work_dir                                # 断点与文档清单所在目录
+        self.concurrency = max(1, concurrency)                  # 同时嵌入的文档数
+        self.migrated = 0                                       # 已迁移的文档数
+
+    def checkpoint(self, name: str) -> MigrationCheckpoint:
+        os.makedirs(self.work_dir, exist_ok = True)
+        return MigrationCheckpoint(os.path.join(self.work_dir, f"{name}.json"))
+
+    async def _manifest(self, kb_helper: KBHelper, name: str, resume: bool) -> list[list]:
+        """源数据库的文档清单[[doc_id, doc_name, created_at], ...],首次迁移时生成,续传时沿用同一份清单"""
+        path = os.path.join(self.work_dir, f"{name}.manifest.json")
+        if resume and os.path.exists(path):
+            async with aiofiles.open(path, 'r', encoding='utf-8') as f:
+                return json.loads(await f.read())
+        docs = await list_kb_documents(kb_helper)
+        docs.sort(key = doc_timestamp)
+        manifest = [[doc.doc_id, doc.doc_name, doc_timestamp(doc)] for doc in docs]
+        await asyncio.to_thread(write_text_atomic, path, json.dumps(manifest, ensure_ascii=False))
+        return manifest
+
+    def _finish(self, checkpoint: MigrationCheckpoint, name: str):
+        checkpoint.remove()
+        path = os.path.join(self.work_dir, f"{name}.manifest.json")
+        if os.path.exists(path):
+            os.remove(path)
+
+    async def _run_bounded(self, items, handler: Callable[[int, object], Awaitable[None]], checkpoint: MigrationCheckpoint) -> int:
+        """并发处理未完成的项,任一项失败时停止提交新项并抛出异常"""
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks: set[asyncio.Task] = set()
+        errors: list[BaseException] = []
+        count = 0
+
+        async def run_one(index: int, item):
+            nonlocal count
+            try:
+                await handler(index, item)
+                await checkpoint.mark(index)
+                count += 1
+                self.migrated += 1
+            except Exception as e:
+                errors.append(e)
+            finally:
+                semaphore.release()
+
+        try:
+            async for index, item in items:
+                if errors:
+                    break
+                if checkpoint.is_done(index):
+                    continue
+                await semaphore.acquire()
+                task = asyncio.create_task(run_one(index, item))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+        finally:
+            # 读取输入出错时也等已经开始的项完成,不留下任务失败后仍在写入断点的上传
+            await asyncio.gather(*set(tasks), return_exceptions = True)
+        if errors:
+            raise errors[0]
+        return count
+
+    @staticmethod
+    async def _enumerate(items: list):
+        for index, item in enumerate(items):
+            yield index, item
+
+    async def export_kb(self, kb_helper: KBHelper, path: str) -> int:
+        """把数据库的所有文档逐行写入JSONL文件,返回本次导出的文档数"""
+        name = f"export_{kb_helper.kb.kb_name}"
+        checkpoint = self.checkpoint(name)
+        resume = checkpoint.load() and os.path.exists(path)
+        if not resume:
+            checkpoint = self.checkpoint(name)
+            checkpoint.extra["bytes"] = 0
+        manifest = await self._manifest(kb_helper, name, resume)
+        count = 0
+        with open(path, "a+b") as f:
+            # 丢弃上次中断时写了一半的行
+            f.truncate(checkpoint.extra.get("bytes", 0))
+            for index in range(checkpoint.offset, len(manifest)):
+                doc_id, doc_name, created_at = manifest[index]
+                chunks = await read_document_chunks(kb_helper, doc_id)
+                line = json.dumps({
+                    "kb_name": kb_helper.kb.kb_name,
+                    "doc_name": doc_name,
+                    "created_at": created_at,
+                    "chunks": chunks
+                }, ensure_ascii=False) + "\n"
+                await asyncio.to_thread(f.write, line.encode("utf-8"))
+                await asyncio.to_thread(f.flush)
+                await checkpoint.mark(index, bytes = f.tell())
+                count += 1
+        self._finish(checkpoint, name)
+        return count
+
+    async def import_file(self, path: str, kb_helper: KBHelper) -> int:
+        """从JSONL文件逐行导入文档并重新嵌入,返回本次导入的文档数"""
+        name = f"import_{kb_helper.kb.kb_name}_{os.path.basename(path)}"
+        checkpoint = self.checkpoint(name)
+        checkpoint.load()
+
+        async def lines():
+            async with aiofiles.open(path, 'r', encoding='utf-8') as f:
+                index = 0
+                while True:
+                    line = await f.readline()
+                    if not line:
+                        break
+                    record = None
+                    if line.strip():
+                        try:
+                            record = json.loads(line)
+                        except json.JSONDecodeError as e:
+                            logger.warning(f"[memorychain] {path}第{index + 1}行不是有效的JSON,已跳过: {e}")
+                        else:
+                            if not isinstance(record, dict) or "doc_name" not in record:
+                                logger.warning(f"[memorychain] {path}第{index + 1}行缺少doc_name,已跳过")
+                                record = None
+                    if record is not None:
+                        yield index, record
+                    elif not checkpoint.is_done(index):
+                        # 空行与跳过的行也记入断点,续传时水位可以越过它们
+                        await checkpoint.mark(index)
+                    index += 1
+
+        async def handle(index: int, record: dict):
+            if record.get("chunks"):
+                await self.uploader(kb_helper, record["doc_name"], record["chunks"])
+
+        count = await self._run_bounded(lines(), handle, checkpoint)
+        checkpoint.remove()
+        return count
+
+    def has_checkpoint(self, name: str) -> bool:
+        return os.path.exists(os.path.join(self.work_dir, f"{name}.json"))
+
+    def _copier(self, source: KBHelper, target: KBHelper) -> Callable[[int, list], Awaitable[None]]:
+        async def handle(index: int, entry: list):
+            doc_id, doc_name, _ = entry
+            chunks = await read_document_chunks(source, doc_id)
+            if chunks:
+                await self.uploader(target, doc_name, chunks)
+        return handle
+
+    async def copy_kb(self, source: KBHelper, target: KBHelper, name: str) -> int:
+        """把源数据库的文档逐个复制到目标数据库,由目标数据库的编码器重新嵌入"""
+        checkpoint = self.checkpoint(name)
+        manifest = await self._manifest(source, name, checkpoint.load())
+        return await self._run_bounded(self._enumerate(manifest), self._copier(source, target), checkpoint)
+
+    async def copy_new_documents(self, source: KBHelper, target: KBHelper, name: str) -> int:
+        """把清单生成后新写入源数据库的文档追加到清单并复制,中断后同样从断点继续"""
+        checkpoint = self.checkpoint(name)
+        checkpoint.load()
+        manifest = await self._manifest(source, name, True)
+        known = {entry[0] for entry in manifest}
+        docs = sorted((doc for doc in await list_kb_documents(source) if doc.doc_id not in known), key = doc_timestamp)
+        if not docs:
+            return 0
+        manifest.extend([doc.doc_id, doc.doc_name, doc_timestamp(doc)] for doc in docs)
+        path = os.path.join(self.work_dir, f"{name}.manifest.json")
+        await asyncio.to_thread(write_text_atomic, path, json.dumps(manifest, ensure_ascii=False))
+        return await self._run_bounded(self._enumerate(manifest), self._copier(source, target), checkpoint)
+
+    def finish(self, name: str):
+        """迁移全部完成后删除断点与清单"""
+        self._finish(self.checkpoint(name), name)
+
+class CircuitBreaker:
+    """连续失败达到阈值后熔断,冷却期内不再调用;冷却结束后放行请求试探,成功则恢复,失败则重新熔断"""
+    def __init__(self, failure_threshold: int = 3, cooldown: float = 60):
+        self.failure_threshold = max(1, failure_threshold)
+        self.cooldown = cooldown
+        self.failures = 0                                       # 连续失败次数
+        self.opened_at: float | None = None                     # 熔断开始的时间
+        self.probing = False                                    # 半开状态下是否已有试探请求在执行
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at >= self.cooldown:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        """熔断期间拒绝;半开状态下已有试探请求时也拒绝"""
+        state = self.state
+        if state == "half_open":
+            return not self.probing
+        return state == "closed"
+
+    def acquire(self) -> str | None:
+        """占用一次调用,返回调用时的状态,不允许调用时返回None;半开状态下只有第一个调用者成为试探请求"""
+        if not self.allow():
+            return None
+        state = self.state
+        if state == "half_open":
+            self.probing = True
+        return state
+
+    def release(self):
+        """试探请求被取消时释放,让下一个调用者试探"""
+        self.probing = False
+
+    def record_success(self):
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def record_failure(self) -> bool:
+        """记录一次失败,返回是否因此熔断"""
+        self.failures += 1
+        self.probing = False
+        if self.failures < self.failure_threshold:
+            return False
+        tripped = self.state != "open"
+        self.opened_at = time.monotonic()
+        return tripped
+
+class FailoverLLM:
+    """压缩用LLM的调用: 单次超时、按提供商熔断、按顺序切换备用提供商
+
+    设置hedge_delay后,当前请求超过该时间仍未返回时同时向下一个提供商发出请求,取先成功的结果
+    """
+    def __init__(
+            self,
+            generate: Callable[[str, str], Awaitable[str]],
+            providers: list[str],
+            timeout: float = 60,                                # 单次调用超时(秒),0为不限制
+            hedge_delay: float = 0,                             # 对冲请求的等待时间(秒),0为关闭
+            failure_threshold: int = 3,
+            cooldown: float = 60,
+            on_event: Callable[[str], None] | None = None       # 计数回调: timeouts/failures/trips/fallbacks/hedges/hedge_wins/rejected
+    ):
+        self.generate = generate                                # (provider_id, prompt) -> 文本
+        self.providers = providers
+        self.timeout = timeout
+        self.hedge_delay = hedge_delay
+        self.on_event = on_event
+        self.breakers = {provider_id: CircuitBreaker(failure_threshold, cooldown) for provider_id in providers}
+
+    def _emit(self, name: str):
+        if self.on_event is not None:
+            self.on_event(name)
+
+    def open_breakers(self) -> int:
+        return sum(1 for breaker in self.breakers.values() if breaker.state == "open")
+
+    async def _attempt(self, provider_id: str, prompt: str) -> str:
+        breaker = self.breakers[provider_id]
+        state = breaker.acquire()
+        if state is None:
+            self._emit("rejected")
+            raise RuntimeError(f"{provider_id}处于熔断状态或正在试探")
+        try:
+            if self.timeout > 0:
+                text = await asyncio.wait_for(self.generate(provider_id, prompt), self.timeout)
+            else:
+                text = await self.generate(provider_id, prompt)
+            if not text:
+                raise ValueError(f"{provider_id}返回了空结果")
+        except asyncio.TimeoutError:
+            self._emit("timeouts")
+            self._failed(provider_id, breaker)
+            raise TimeoutError(f"{provider_id}在{self.timeout}秒内没有返回")
+        except asyncio.CancelledError:
+            if state == "half_open":
+                breaker.release()
+            raise
+        except Exception:
+            self._failed(provider_id, breaker)
+            raise
+        breaker.record_success()
+        return text
+
+    def _failed(self, provider_id: str, breaker: CircuitBreaker):
+        self._emit("failures")
+        if breaker.record_failure():
+            self._emit("trips")
+            logger.warning(f"[memorychain] LLM提供商{provider_id}连续失败{breaker.failures}次,熔断{breaker.cooldown}秒")
+
+    async def generate_text(self, prompt: str) -> str:
+        candidates = [provider_id for provider_id in self.providers if self.breakers[provider_id].allow()]
+        if not candidates:
+            self._emit("rejected")
+            raise RuntimeError("所有LLM提供商都处于熔断状态")
+        pending: dict[asyncio.Task, tuple[str, bool]] = {}      # 请求 -> (提供商, 是否为对冲请求)
+        next_index = 0
+        last_error: BaseException | None = None
+
+        def launch(hedged: bool):
+            nonlocal next_index
+            provider_id = candidates[next_index]
+            next_index += 1
+            pending[asyncio.create_task(self._attempt(provider_id, prompt))] = (provider_id, hedged)
+
+        launch(False)
+        try:
+            while pending:
+                can_hedge = self.hedge_delay > 0 and next_index < len(candidates)
+                done, _ = await asyncio.wait(
+                    pending, timeout = self.hedge_delay if can_hedge else None, return_when = asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    self._emit("hedges")
+                    launch(True)
+                    continue
+                for task in done:
+                    provider_id, hedged = pending.pop(task)
+                    try:
+                        text = task.result()
+                    except Exception as e:
+                        last_error = e
+                        logger.warning(f"[memorychain] LLM提供商{provider_id}调用失败: {e}")
+                        continue
+                    if hedged:
+                        self._emit("hedge_wins")
+                    return text
+                if not pending and next_index < len(candidates):
+                    self._emit("fallbacks")
+                    launch(False)
+            raise last_error
+        finally:
+            for task in pending:
+                task.cancel()
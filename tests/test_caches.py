@@ -0,0 +1,82 @@
+"""句柄缓存、检索缓存代数与写入锁的上限测试"""
+import asyncio
+import tempfile
+
+from test_eviction import make_plugin
+
+
+def test_caches_stay_bounded_across_many_sessions():
+    data_dir = tempfile.mkdtemp(prefix="memorychain_test_")
+
+    async def scenario():
+        plugin = make_plugin(data_dir, max_sessions=10)
+        for index in range(100):
+            kb_name = f"群{index}记忆链"
+            await plugin.kb_handles.get(kb_name)
+            plugin.retrieval_cache.invalidate(kb_name)
+            async with plugin._kb_lock(kb_name):
+                pass
+        return plugin
+
+    plugin = asyncio.run(scenario())
+    assert len(plugin.kb_handles.entries) == 10
+    assert list(plugin.kb_handles.entries)[-1] == "群99记忆链"
+    assert len(plugin.retrieval_cache.generations) == 10
+    assert len(plugin._kb_locks.locks) == 10
+
+
+def test_expired_negative_entries_are_pruned_first():
+    data_dir = tempfile.mkdtemp(prefix="memorychain_test_")
+
+    async def scenario():
+        plugin = make_plugin(data_dir, max_sessions=3)
+        cache = plugin.kb_handles
+        kb_helper = await plugin.context.kb_manager.create_kb("群0记忆链", embedding_provider_id="fake-embedding")
+        cache.set("群0记忆链", kb_helper)
+        cache.negative_ttl = -1
+        await cache.get("群1记忆链")
+        await cache.get("群2记忆链")
+        cache.negative_ttl = 30
+        await cache.get("群3记忆链")
+        return cache
+
+    cache = asyncio.run(scenario())
+    # 过期的负缓存被清理,最久未用但仍有效的句柄保留
+    assert list(cache.entries) == ["群0记忆链", "群3记忆链"]
+
+
+def test_evicted_generation_rejects_in_flight_results():
+    data_dir = tempfile.mkdtemp(prefix="memorychain_test_")
+    plugin = make_plugin(data_dir, max_sessions=2)
+    cache = plugin.retrieval_cache
+    generation = cache.generation("群0记忆链")
+    cache.invalidate("群0记忆链")
+    cache.invalidate("群1记忆链")
+    cache.invalidate("群2记忆链")
+    # 群0的代数被淘汰后归零,检索开始时记下的旧代数不能再回填
+    cache.put("群0记忆链", "你好", {"results": []}, generation)
+    assert cache.get("群0记忆链", "你好") is None
+
+
+def test_held_locks_are_not_evicted():
+    data_dir = tempfile.mkdtemp(prefix="memorychain_test_")
+
+    async def scenario():
+        plugin = make_plugin(data_dir, max_sessions=2)
+        order = []
+
+        async def writer(tag: str):
+            async with plugin._kb_lock("群0记忆链"):
+                order.append(f"{tag}开始")
+                await asyncio.sleep(0.01)
+                order.append(f"{tag}结束")
+
+        first = asyncio.create_task(writer("a"))
+        await asyncio.sleep(0)
+        for index in range(1, 10):
+            async with plugin._kb_lock(f"群{index}记忆链"):
+                pass
+        await asyncio.gather(first, writer("b"))
+        return order
+
+    assert asyncio.run(scenario()) == ["a开始", "a结束", "b开始", "b结束"]
@@ -0,0 +1,82 @@
+"""会话淘汰与压缩队列的回归测试,使用bench中的astrbot替身"""
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(ROOT, "bench"))
+sys.path.insert(0, ROOT)
+
+from fakes import FakeContext, FakeEvent, Latency, ProviderRequest, install_astrbot_stubs  # noqa: E402
+
+
+def make_plugin(data_dir: str, **config):
+    install_astrbot_stubs(data_dir)
+    import main
+
+    plugin = main.memorychain(FakeContext(Latency(llm=0.01, embed=0, search=0, db_write=0)), {"enabled": 1, **config})
+    plugin.llm_name = "fake-llm"
+    plugin.ep_name = "fake-embedding"
+    return plugin
+
+
+def run_with_deadline(coro, timeout: float = 30):
+    """在线程中运行协程,事件循环被同步死循环卡住时wait_for无法生效,只能从外部判断超时"""
+    result = {}
+
+    def target():
+        result["value"] = asyncio.run(coro)
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), f"协程在{timeout}秒内没有结束,事件循环可能被淘汰循环卡住"
+    return result.get("value")
+
+
+async def fill_journal(data_dir: str, sessions: int, messages: int):
+    plugin = make_plugin(data_dir, max_sessions=sessions * 2, compress_threshold=1000, max_history=1000)
+    await plugin.initialize()
+    for index in range(sessions):
+        for message_index in range(messages):
+            await plugin._buffer_message(f"s{index}", "user", f"消息{message_index}", f"群{index}记忆链")
+    await plugin.terminate()
+
+
+def test_restart_with_small_max_sessions_does_not_freeze():
+    data_dir = tempfile.mkdtemp(prefix="memorychain_test_")
+
+    async def scenario():
+        await fill_journal(data_dir, sessions=200, messages=12)
+        plugin = make_plugin(data_dir, max_sessions=10, compress_queue_size=20, compress_workers=1)
+        await plugin.initialize()
+        event = FakeEvent("999", "1", "user", "你好")
+        await asyncio.wait_for(plugin.on_llm_request(event, ProviderRequest(prompt="你好")), 10)
+        sessions = len(plugin.compressor.compressed_chats)
+        await plugin.terminate()
+        return sessions
+
+    assert run_with_deadline(scenario()) <= 10
+
+
+def test_dropped_jobs_do_not_recreate_evicted_sessions():
+    data_dir = tempfile.mkdtemp(prefix="memorychain_test_")
+
+    async def scenario():
+        plugin = make_plugin(data_dir, max_sessions=5, compress_queue_size=2, compress_workers=1, evict_flush_min=1)
+        await plugin.initialize()
+        evictions = []
+        for index in range(30):
+            before = plugin.compressor.evicted
+            await plugin._buffer_message(f"s{index}", "user", "消息", f"群{index}记忆链")
+            evictions.append(plugin.compressor.evicted - before)
+        sessions = len(plugin.compressor.compressed_chats)
+        await plugin.terminate()
+        return evictions, sessions
+
+    evictions, sessions = run_with_deadline(scenario())
+    # 每个新会话最多淘汰一个旧会话,被丢弃的压缩任务不会把会话放回内存
+    assert max(evictions) <= 1
+    assert sessions <= 5
@@ -0,0 +1,23 @@
+"""检索前过滤的回归测试"""
+import asyncio
+import tempfile
+
+from test_eviction import FakeEvent, ProviderRequest, make_plugin
+
+
+def test_skipped_messages_do_not_look_up_databases():
+    data_dir = tempfile.mkdtemp(prefix="memorychain_test_")
+
+    async def scenario():
+        plugin = make_plugin(data_dir, global_kb_name="全局记忆链", kb_negative_ttl=0)
+        await plugin.context.kb_manager.create_kb("群1记忆链", embedding_provider_id="fake-embedding")
+        await plugin.on_llm_request(FakeEvent("1", "2", "user", "今天吃什么"), ProviderRequest(prompt="今天吃什么"))
+        lookups = plugin.context.counters.kb_lookups
+        for message in ("好的", "哈哈哈", "/help"):
+            await plugin.on_llm_request(FakeEvent("1", "2", "user", message), ProviderRequest(prompt=message))
+        return lookups, plugin.context.counters.kb_lookups, plugin.metrics.counters.get("gate_saved_searches", 0)
+
+    before, after, saved = asyncio.run(scenario())
+    assert after == before
+    # 只有群记忆数据库存在,全局记忆数据库是负缓存,不计入省下的检索
+    assert saved == 3
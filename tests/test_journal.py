@@ -0,0 +1,26 @@
+"""聊天日志回放的回归测试"""
+import asyncio
+import tempfile
+
+from test_eviction import fill_journal, make_plugin
+
+
+def test_replay_keeps_only_recent_sessions_in_memory():
+    data_dir = tempfile.mkdtemp(prefix="memorychain_test_")
+
+    async def scenario():
+        await fill_journal(data_dir, sessions=50, messages=3)
+        plugin = make_plugin(data_dir, max_sessions=10)
+        await plugin.initialize()
+        loaded = list(plugin.compressor.compressed_chats)
+        parked = set(plugin.journal.parked)
+        # 被留在日志中的会话再次活跃时载入全部消息
+        chat = await plugin._buffer_message("s0", "user", "回来了", "群0记忆链")
+        messages = list(chat.recent_messages)
+        await plugin.terminate()
+        return loaded, parked, messages
+
+    loaded, parked, messages = asyncio.run(scenario())
+    assert loaded == [f"s{index}" for index in range(40, 50)]
+    assert parked == {f"s{index}" for index in range(40)}
+    assert messages == ["user: 消息0", "user: 消息1", "user: 消息2", "user: 回来了"]
@@ -0,0 +1,154 @@
+"""记忆数据库导入、重新嵌入与整理的并发回归测试"""
+import asyncio
+import json
+import os
+import tempfile
+import time
+
+from test_eviction import make_plugin
+
+
+class Reply:
+    def plain_result(self, text):
+        return text
+
+
+async def collect(generator) -> list:
+    return [item async for item in generator]
+
+
+def test_import_skips_bad_lines_and_waits_for_uploads():
+    data_dir = tempfile.mkdtemp(prefix="memorychain_test_")
+
+    async def scenario():
+        plugin = make_plugin(data_dir)
+        await plugin.initialize()
+        path = os.path.join(data_dir, "import.jsonl")
+        records = [json.dumps({"doc_name": f"文档{index}", "chunks": [f"内容{index}"]}, ensure_ascii=False) for index in range(7)]
+        records.insert(3, "{坏掉的一行")
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("\n".join(records) + "\n")
+        kb_helper = await plugin._get_or_create_memory_kb("群1记忆链")
+        count = await plugin.migrator.import_file(path, kb_helper)
+        documents = len(kb_helper.documents)
+        await asyncio.sleep(0.05)
+        await plugin.terminate()
+        return count, documents, len(kb_helper.documents)
+
+    count, documents, later = asyncio.run(scenario())
+    assert count == documents == later == 7
+
+
+def test_run_bounded_waits_for_started_items_when_input_fails():
+    data_dir = tempfile.mkdtemp(prefix="memorychain_test_")
+
+    async def scenario():
+        plugin = make_plugin(data_dir, migrate_concurrency=4)
+        finished = []
+
+        async def items():
+            for index in range(3):
+                yield index, index
+            raise ValueError("输入损坏")
+
+        async def handle(index, item):
+            await asyncio.sleep(0.05)
+            finished.append(index)
+
+        checkpoint = plugin.migrator.checkpoint("bounded")
+        try:
+            await plugin.migrator._run_bounded(items(), handle, checkpoint)
+        except ValueError:
+            pass
+        return sorted(finished), checkpoint.offset
+
+    finished, offset = asyncio.run(scenario())
+    assert finished == [0, 1, 2]
+    assert offset == 3
+
+
+def test_reembed_does_not_recover_a_running_swap():
+    data_dir = tempfile.mkdtemp(prefix="memorychain_test_")
+
+    async def scenario():
+        plugin = make_plugin(data_dir)
+        await plugin.initialize()
+        kb_manager = plugin.context.kb_manager
+        # 另一个重新嵌入正处于切换阶段: 原名称空缺,备份与临时数据库同时存在
+        await kb_manager.create_kb("群1记忆链_迁移前", embedding_provider_id="fake-embedding")
+        await kb_manager.create_kb("群1记忆链_迁移中", embedding_provider_id="fake-embedding")
+        swap = asyncio.Event()
+        plugin._migration_task = asyncio.create_task(swap.wait())
+        replies = await collect(plugin.reembed_kbs(Reply(), "群1记忆链", "fake-embedding"))
+        await asyncio.sleep(0)
+        names = sorted(kb_helper.kb.kb_name for kb_helper in kb_manager.kb_insts.values())
+        swap.set()
+        await plugin.terminate()
+        return replies, names
+
+    replies, names = asyncio.run(scenario())
+    assert replies == ["已有导出/导入/重新嵌入任务在进行中"]
+    assert names == ["群1记忆链_迁移中", "群1记忆链_迁移前"]
+
+
+def test_compaction_stops_writing_once_kb_starts_migrating():
+    data_dir = tempfile.mkdtemp(prefix="memorychain_test_")
+
+    async def scenario():
+        plugin = make_plugin(data_dir, compaction_throttle=0, compaction_min_docs=2)
+        await plugin.initialize()
+        kb_helper = await plugin._get_or_create_memory_kb("群1记忆链")
+        old = time.time() - 60 * 86400
+        for period in range(3):
+            for index in range(2):
+                doc = await kb_helper.upload_document(f"群1_{period}_{index}", None, "txt", pre_chunked_text=[f"记忆{period}{index}"])
+                doc.created_at = old - period * 14 * 86400
+        before = set(kb_helper.documents)
+        summarize = plugin.compactor.summarize
+
+        async def start_migration_during_merge(prompt):
+            # 第一次合并期间该数据库进入重新嵌入
+            plugin._migrating.add("群1记忆链")
+            return await summarize(prompt)
+
+        plugin.compactor.summarize = start_migration_during_merge
+        await plugin._compact([kb_helper])
+        after = set(kb_helper.documents)
+        await plugin.terminate()
+        return before, after
+
+    before, after = asyncio.run(scenario())
+    assert after == before
+
+
+def test_compaction_pauses_before_each_merged_delete():
+    data_dir = tempfile.mkdtemp(prefix="memorychain_test_")
+
+    async def scenario():
+        plugin = make_plugin(data_dir, compaction_throttle=0, compaction_min_docs=2)
+        await plugin.initialize()
+        kb_helper = await plugin._get_or_create_memory_kb("群1记忆链")
+        for index in range(3):
+            doc = await kb_helper.upload_document(f"群1_{index}", None, "txt", pre_chunked_text=[f"记忆{index}"])
+            doc.created_at = time.time() - 60 * 86400
+        calls = []
+        pause, delete = plugin.compactor._pause, kb_helper.delete_document
+
+        async def record_pause():
+            calls.append("pause")
+            await pause()
+
+        async def record_delete(doc_id):
+            calls.append("delete")
+            await delete(doc_id)
+
+        plugin.compactor._pause = record_pause
+        kb_helper.delete_document = record_delete
+        await plugin._compact([kb_helper])
+        await plugin.terminate()
+        return calls
+
+    calls = asyncio.run(scenario())
+    # 删除被合并的原文档之间同样让出时间给实时对话
+    assert calls.count("delete") == 3
+    assert all(calls[index - 1] == "pause" for index, call in enumerate(calls) if call == "delete")